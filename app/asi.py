@@ -1,9 +1,13 @@
 """
 This file contains the utility functions that are used in the main application.
 """
+import io
+import copy
 import uuid
 import os
 import logging
+import tempfile
+import threading
 
 from docx import Document
 from docx.shared import Pt, Inches
@@ -16,24 +20,97 @@ from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.ns import nsdecls
 from docx.oxml import OxmlElement
-from docx2pdf import convert
+from lxml import etree
 
-from google.cloud import storage
-from google.oauth2 import service_account
-
-from app.utils import convert_docx_to_pdf
+from app.cache import canonical_hash, get_fragment_cache
+from app.config import settings
+from app.converter import get_converter_pool
+from app.metrics import stage
+from app.pdf import render_pdf
+from app.rows import parse_elements, header_rows, employment_table, heading, paragraph
+from app.storage import object_name, upload_file
 
 
 logger = logging.getLogger(__name__)
 
+# bump whenever the layout built by ASI_CV changes so cached renders are not reused
+TEMPLATE_VERSION = "2"
+
+
+def scratch_dir():
+    """
+    Returns the directory used for conversion scratch files, preferring tmpfs
+    """
+    if settings.SCRATCH_DIR:
+        return settings.SCRATCH_DIR
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+_shading_elements = {}
+_border_elements = {}
+
+
+def shading_element(fill):
+    """
+    Returns a new <w:shd> element, copied from a prototype parsed once per fill color
+    """
+    prototype = _shading_elements.get(fill)
+    if prototype is None:
+        prototype = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), fill))
+        _shading_elements[fill] = prototype
+    return copy.deepcopy(prototype)
+
+
+def bottom_border_element(color="000000", width=4, space=1):
+    """
+    Returns a new <w:pBdr> with a single bottom rule, copied from a prototype built once per style
+    """
+    key = (color, width, space)
+    prototype = _border_elements.get(key)
+    if prototype is None:
+        prototype = OxmlElement('w:pBdr')
+        bottom_border = OxmlElement('w:bottom')
+        bottom_border.set(qn('w:val'), 'single')  # Single line
+        bottom_border.set(qn('w:sz'), str(width))  # Size of the border, e.g., a value of 4 is 1/2 point
+        bottom_border.set(qn('w:space'), str(space))  # The space above the border, e.g., 1/8 point
+        bottom_border.set(qn('w:color'), color)  # The color of the border
+        prototype.append(bottom_border)
+        _border_elements[key] = prototype
+    return copy.deepcopy(prototype)
 
 
 class ASI_CV:
     """
     This class is used to create a CV for an ASI employee.
     """
-    def __init__(self):
-        self.doc = Document()
+    _skeleton = None
+    _skeleton_lock = threading.Lock()
+
+    @classmethod
+    def skeleton(cls):
+        """
+        Returns the package of the styled base document (margins, Normal style
+        and the empty four column header table), built once per process
+        """
+        if cls._skeleton is None:
+            with cls._skeleton_lock:
+                if cls._skeleton is None:
+                    base = cls(use_skeleton=False)
+                    base.setup_document()
+                    base.create_header_table()
+                    # keep the package rather than the Document, which caches proxies of body elements
+                    cls._skeleton = base.doc.part.package
+        return cls._skeleton
+
+    def __init__(self, use_skeleton=True):
+        # deep-copying the parsed skeleton is several times cheaper than loading and styling a new Document
+        if use_skeleton:
+            self.doc = copy.deepcopy(self.skeleton()).main_document_part.document
+        else:
+            self.doc = Document()
+        self.use_skeleton = use_skeleton
         self.file_id = str(uuid.uuid4())
         self.qualifications = []
         self.technical_skills = []
@@ -43,6 +120,7 @@ class ASI_CV:
         self.experiences = []
         self.filename = None
         self.docx_file = None
+        self.rebuilt_sections = []
         
     def _add_name_title(self, name, title, create = False):
         self.name = name
@@ -107,55 +185,202 @@ class ASI_CV:
             # TODO: Add the experience to the document
             pass
 
-    def _add_raw_experience(self, date_range, experience_header, experience_content):
+    def _add_raw_experience(self, date_range, experience_header, experience_content, is_selected=True):
         self.experiences.append({
             "Date Range": date_range,
             "Header": experience_header,
             "Content": experience_content,
-            "IsSelected": True
+            "IsSelected": is_selected
         })
 
-    def generate_cv(self, filename=None, file_format="pdf", output_type="url", save=False, bucket_name=None, folder=None, credentials=None):
+    def generate_cv(self, filename=None, file_format="pdf", output_type="url", save=False, bucket_name=None, folder=None, credentials=None, stream=False, pdf_engine="libreoffice", pdf_profile="default"):
         """
         This function is used to generate the CV for the ASI employee.
+
+        With stream=True a file output is returned as an open file object instead of bytes.
+        With pdf_engine='native' the pdf is laid out in-process instead of converted from the docx,
+        otherwise it is converted with the LibreOffice options of the pdf_profile export profile.
         """
         if file_format not in ["docx", "pdf"]:
             raise ValueError("The file format should be either 'docx' or 'pdf'")
         if output_type not in ["url", "file"]:
             raise ValueError("The output type should be either 'url' or 'file'")
-        self.setup_document()
-        self.add_table()
-        self.add_heading("Summary of Experience")
-        for summary in self.summary_of_experience:
-            self.add_paragraph(summary, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
-        self.add_heading("Employment History")
-        self.add_employment_table()
-        self.add_heading("Selected Experience")
-        selected_experiences = [experience for experience in self.experiences if experience.get("IsSelected") is True]
-        for experience in selected_experiences:
-            self.add_heading(experience["Header"] + " (" + experience["Date Range"] + ")", line=False, space_before=4, space_after=0)
-            self.add_paragraph(experience["Content"], alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY, space_before=0, space_after=4)
+        if file_format == "pdf" and pdf_engine == "native":
+            output = self.save_native_pdf_stream()
+            if output_type == "url":
+                if bucket_name is None or folder is None or credentials is None:
+                    raise ValueError("The bucket name, folder and credentials should be provided when the output type is 'url'")
+                with output:
+                    return self.upload(output, file_format, bucket_name, folder, credentials)
+            if stream and not save:
+                return output
+            with output:
+                file_bytes = output.read()
+            if save:
+                self._write_output(file_bytes, os.path.splitext(filename or self.file_id)[0] + ".pdf", folder or "outputs")
+            return file_bytes
+        self.build_document()
         if output_type == "url":
             if bucket_name is None or folder is None or credentials is None:
                 raise ValueError("The bucket name, folder and credentials should be provided when the output type is 'url'")        
-            credentials = service_account.Credentials.from_service_account_file(credentials)
-            google_storage_client = storage.Client(credentials=credentials)
-            bucket = google_storage_client.get_bucket(bucket_name)
             if file_format == "docx":
-                file_bytes = self.save_docx(filename=filename, save=False)
+                output = self.save_docx_stream()
             if file_format == "pdf":
-                file_bytes = self.save_pdf(filename=filename, save=False)
-            blob = bucket.blob(folder + "/" + self.name +" ASI CV Export" +self.file_id+ "." + file_format)
-            blob.upload_from_string(file_bytes, content_type="application/" + file_format)
-            blob.make_public()
-            return blob.public_url
+                output = self.save_pdf_stream(filename=filename, pdf_profile=pdf_profile)
+            with output:
+                return self.upload(output, file_format, bucket_name, folder, credentials)
         if output_type == "file":
+            if stream and not save:
+                if file_format == "docx":
+                    return self.save_docx_stream()
+                if file_format == "pdf":
+                    return self.save_pdf_stream(filename=filename, pdf_profile=pdf_profile)
             if folder is None:
                 folder = "outputs"
             if file_format == "docx":
                 return self.save_docx(filename=filename, save=save, folder=folder)
             if file_format == "pdf":
-                return self.save_pdf(filename=filename, save=save, folder=folder)
+                return self.save_pdf(filename=filename, save=save, folder=folder, pdf_profile=pdf_profile)
+
+    def build_document(self):
+        """
+        Adds every section of the CV to the document
+        """
+        with stage("build"):
+            if not self.use_skeleton:
+                self.setup_document()
+            tables = self.doc.tables
+            # the skeleton's empty header table is filled on a miss and replaced on a hit
+            placeholder = tables[0]._tbl if tables and len(tables[0].rows) == 0 else None
+            self.build_section("header", [self.name, self.title, self.header_rows()], self.add_table, placeholder=placeholder)
+            self.build_section("summary", self.summary_of_experience, self.add_summary)
+            self.build_section("employment", [[experience["Date Range"], experience.get("Header")] for experience in self.experiences],
+                               self.add_employment_history)
+            self.add_heading("Selected Experience")
+            for experience in self.selected_experiences():
+                self.build_section("experience", [experience["Header"], experience["Date Range"], experience["Content"]],
+                                   lambda: self.add_selected_experience(experience))
+
+    def build_section(self, name, content, build, placeholder=None):
+        """
+        Adds a section of the CV from the fragment cache, building and caching it when its content is new.
+
+        Sections are keyed by their content alone, so regenerating an edited
+        profile only builds the sections that changed and reuses the XML of the rest.
+        """
+        cache = get_fragment_cache()
+        key = canonical_hash(name, content, TEMPLATE_VERSION)
+        body = self.doc.element.body
+        fragment = cache.get(key)
+        if fragment is not None:
+            if placeholder is not None:
+                body.remove(placeholder)
+            sectPr = body.sectPr
+            for element in list(parse_xml(fragment)):
+                if sectPr is not None:
+                    sectPr.addprevious(element)
+                else:
+                    body.append(element)
+            return
+        start = body.index(placeholder) if placeholder is not None else len(body) - (body.sectPr is not None)
+        build()
+        elements = [element for element in body[start:] if element.tag != qn("w:sectPr")]
+        self.rebuilt_sections.append(name)
+        cache.set(key, b"<fragment>" + b"".join(etree.tostring(element) for element in elements) + b"</fragment>")
+
+    def add_summary(self):
+        self.append_xml(heading("Summary of Experience"),
+                        *[paragraph(summary, alignment="both") for summary in self.summary_of_experience])
+
+    def add_employment_history(self):
+        self.append_xml(heading("Employment History"), employment_table(self.experiences))
+
+    def add_selected_experience(self, experience):
+        self.append_xml(heading(experience["Header"] + " (" + experience["Date Range"] + ")", line=False, space_before=4, space_after=0),
+                        paragraph(experience["Content"], alignment="both", space_before=0, space_after=4))
+
+    def append_xml(self, *elements):
+        """
+        Appends elements written by app.rows to the body, before its section properties
+        """
+        body = self.doc.element.body
+        sectPr = body.sectPr
+        for element in parse_elements(elements):
+            if sectPr is not None:
+                sectPr.addprevious(element)
+            else:
+                body.append(element)
+
+    @property
+    def export_name(self):
+        return self.name + " ASI CV Export"
+
+    def upload(self, file, file_format, bucket_name, folder, credentials):
+        """
+        Uploads the rendered bytes or file to the storage backend and returns its url
+        """
+        blob_name = object_name(folder, self.name, self.file_id, file_format)
+        return upload_file(file, blob_name, "application/" + file_format, bucket_name, credentials,
+                           filename=self.export_name + "." + file_format)
+
+    def render(self, file_format="pdf", filename=None, pdf_engine="libreoffice", pdf_profile="default"):
+        """
+        Builds the document and returns it as docx or pdf bytes
+        """
+        if file_format == "pdf" and pdf_engine == "native":
+            return render_pdf(self)
+        self.build_document()
+        docx_bytes = self.save_docx(filename=filename)
+        self.release_document()
+        if file_format == "docx":
+            return docx_bytes
+        with self.save_pdf_stream(filename=filename, docx_bytes=docx_bytes, pdf_profile=pdf_profile) as file:
+            return file.read()
+
+    def render_stream(self, file_format="pdf", filename=None, pdf_engine="libreoffice", pdf_profile="default"):
+        """
+        Builds the document and returns it as an open docx or pdf file
+        """
+        if file_format == "pdf" and pdf_engine == "native":
+            return self.save_native_pdf_stream()
+        self.build_document()
+        if file_format == "docx":
+            output = self.save_docx_stream()
+            self.release_document()
+            return output
+        docx_bytes = self.save_docx(filename=filename)
+        self.release_document()
+        return self.save_pdf_stream(filename=filename, docx_bytes=docx_bytes, pdf_profile=pdf_profile)
+
+    def render_formats(self, file_formats, filename=None, pdf_engine="libreoffice", pdf_profile="default"):
+        """
+        Builds the document once and returns a dict of its bytes per format.
+
+        The docx is serialized once and the same bytes are the input of the pdf conversion.
+        """
+        files = {}
+        native = pdf_engine == "native"
+        if "docx" in file_formats or ("pdf" in file_formats and not native):
+            self.build_document()
+            docx_bytes = self.save_docx(filename=filename)
+            self.release_document()
+            if "docx" in file_formats:
+                files["docx"] = docx_bytes
+        if "pdf" in file_formats:
+            if native:
+                files["pdf"] = render_pdf(self)
+            else:
+                with self.save_pdf_stream(filename=filename, docx_bytes=docx_bytes, pdf_profile=pdf_profile) as file:
+                    files["pdf"] = file.read()
+        return files
+
+    def release_document(self):
+        """
+        Drops the document tree and the serialized docx once the bytes are handed on, so a
+        render does not hold them through the conversion and upload that follow
+        """
+        self.doc = None
+        self.docx_file = None
 
     def setup_document(self):
         self.set_margins()
@@ -180,43 +405,82 @@ class ASI_CV:
             self.filename = self.file_id + ".docx"
         else:
             self.filename = filename
-        # TODO: Output the file to a folder
-        self.doc.save(self.filename)
-        # covert the docx file into bytes
-        with open(self.filename, "rb") as file:
-            file_bytes = file.read()
-        if not save:
-            os.remove(self.filename)
+        # serialize straight into memory, the disk is only touched when the file is kept
+        buffer = io.BytesIO()
+        with stage("serialize"):
+            self.doc.save(buffer)
+        file_bytes = buffer.getvalue()
+        if save:
+            self._write_output(file_bytes, self.filename, folder)
         self.docx_file = file_bytes
         return file_bytes
 
-    def save_pdf(self, filename=None, save=False, folder='outputs'):
+    def save_docx_stream(self):
+        """
+        Serializes the document into a spooled file, kept in memory up to SPOOL_MAX_SIZE
+        """
+        output = tempfile.SpooledTemporaryFile(max_size=settings.SPOOL_MAX_SIZE, dir=scratch_dir())
+        with stage("serialize"):
+            self.doc.save(output)
+        output.seek(0)
+        return output
+
+    def save_pdf_stream(self, filename=None, docx_bytes=None, pdf_profile="default"):
+        """
+        Converts the document and returns the pdf as an open file, its scratch directory is already removed
+
+        docx_bytes are converted as is when the document was already serialized. The pdf is
+        exported with the LibreOffice options of the pdf_profile export profile.
+        """
         if filename is None:
             self.filename = self.file_id + ".docx"
         else:
             self.filename = filename
-        # TODO: Output the file to a folder
-        pdf_file = self.filename.replace(".docx", ".pdf")
-        # check if the os is windows
-        # TODO: Check if the system has MS Word installed
-        if os.name == 'nt':
-            print("Windows")
-            # When using system that has MS Word installed
-            from docx2pdf import convert
-            convert(self.filename, pdf_file)
-        else:
-            print("Linux")
+        if docx_bytes is None:
+            docx_bytes = self.save_docx(self.filename)
+        # the converters only work on files so use a RAM backed scratch directory when there is one
+        with tempfile.TemporaryDirectory(prefix="asi-cv-", dir=scratch_dir()) as scratch:
+            docx_file = os.path.join(scratch, os.path.basename(self.filename))
+            pdf_file = os.path.splitext(docx_file)[0] + ".pdf"
+            with open(docx_file, "wb") as file:
+                file.write(docx_bytes)
+            # check if the os is windows
+            # TODO: Check if the system has MS Word installed
+            if os.name == 'nt':
+                # When using system that has MS Word installed, docx2pdf is windows only so it is imported here
+                from docx2pdf import convert
+                with stage("convert"):
+                    convert(docx_file, pdf_file)
+                # open files can not be unlinked on windows
+                with open(pdf_file, "rb") as file:
+                    return io.BytesIO(file.read())
             # When using system that does not have MS Word installed
-            self.save_docx(self.filename, save=True)
-            convert_docx_to_pdf(self.filename, pdf_file)
-        with open(pdf_file, "rb") as file:
+            get_converter_pool().convert(docx_file, pdf_file, pdf_profile=pdf_profile)
+            # the open handle stays readable after the directory is removed
+            return open(pdf_file, "rb")
+
+    def save_native_pdf_stream(self):
+        """
+        Lays the pdf out straight from the profile data, no docx is built
+        """
+        return io.BytesIO(render_pdf(self))
+
+    def save_pdf(self, filename=None, save=False, folder='outputs', pdf_profile="default"):
+        with self.save_pdf_stream(filename=filename, pdf_profile=pdf_profile) as file:
             file_bytes = file.read()
-        if not save:
-            os.remove(pdf_file)
-        os.remove(self.filename)
+        if save:
+            self._write_output(file_bytes, os.path.splitext(self.filename)[0] + ".pdf", folder)
         return file_bytes
-    
-    def add_table(self):
+
+    def _write_output(self, file_bytes, filename, folder):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            filename = os.path.join(folder, os.path.basename(filename))
+        with open(filename, "wb") as file:
+            file.write(file_bytes)
+        return filename
+
+    def create_header_table(self):
         table = self.doc.add_table(rows=0, cols=4)
         table.style = 'Table Grid'
         # Define the border color and cell background color
@@ -236,16 +500,30 @@ class ASI_CV:
                     element.set('w:color', border_color)  # set border color
                 
                 # Set cell background color
-                shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), cell_background_color))
-                tcPr.append(shading_elm)
+                tcPr.append(shading_element(cell_background_color))
         table.columns[0].width = Inches(1.5)
         table.columns[1].width = Inches(2)
         table.columns[2].width = Inches(1.5)
         table.columns[3].width = Inches(2.5)
         # add padding to the left and right of the table as table is getting outside of the page
         table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        return table
+
+    def add_table(self):
+        tables = self.doc.tables
+        if tables and len(tables[0].rows) == 0:
+            # the header table is already laid out by the skeleton
+            table = tables[0]
+        else:
+            table = self.create_header_table()
 
-        self.add_table_row_with_two_columns(table, ["Name", "Position"], [[self.name], [self.title]], 'D9E2F3', bold=False, bullet=False)
+        # the rows are written in one pass, add_table_row adds them one at a time
+        table._tbl.extend(parse_elements(header_rows(self.name, self.title, self.header_rows(), 'D9E2F3')))
+
+    def header_rows(self):
+        """
+        Returns the (heading, items, bullet) rows of the header table below the name and position
+        """
         '''
         if self.qualifications[0].get("Degree"):
             formated_qualifications = [ qualification.get("Degree") + " in " + qualification.get("Field") + " from " + qualification.get("Institution") + " in " + qualification.get("Year") for qualification in self.qualifications]
@@ -253,10 +531,15 @@ class ASI_CV:
         '''
         formated_qualifications = self.qualifications
         formated_languages = [ language.get("Language") + " (" + language.get("Proficiency") + ")" for language in self.languages]
-        self.add_table_row(table, "Qualification", formated_qualifications, 'D9E2F3', bold=False, bullet=True)
-        self.add_table_row(table, "Countries", self.countries, 'D9E2F3', bold=False, bullet=False)
-        self.add_table_row(table, "Technical Skills", self.technical_skills, 'D9E2F3', bold=False, bullet=False)
-        self.add_table_row(table, "Language Skills", formated_languages, 'D9E2F3', bold=False, bullet=False)
+        return [
+            ("Qualification", formated_qualifications, True),
+            ("Countries", self.countries, False),
+            ("Technical Skills", self.technical_skills, False),
+            ("Language Skills", formated_languages, False),
+        ]
+
+    def selected_experiences(self):
+        return [experience for experience in self.experiences if experience.get("IsSelected") is True]
 
     def add_paragraph(self, text, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT, space_before=4, space_after=4):
         p = self.doc.add_paragraph(text)
@@ -282,6 +565,9 @@ class ASI_CV:
         return heading
     
     def add_employment_table(self, experiences=None):
+        """
+        Adds the employment table cell by cell, add_employment_history writes it in one pass with app.rows
+        """
         employment_table = self.doc.add_table(rows=0, cols=2)
         employment_table.style = 'TableNormal'
         employment_table.columns[0].width = Inches(1.5)
@@ -325,8 +611,7 @@ class ASI_CV:
                 run.font.size = Pt(10)
                 run.font.name = 'Arial'
                 paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.JUSTIFY
-        shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), shade))
-        cell._tc.get_or_add_tcPr().append(shading_elm)
+        cell._tc.get_or_add_tcPr().append(shading_element(shade))
         return cell
 
     def add_table_row(self, table, heading, list, shade, bold=False, bullet=False):
@@ -373,11 +658,4 @@ class ASI_CV:
 
     def add_horizontal_line(self, p, color="000000", width=4, space=1):
         # add a horizontal line
-        p_border = OxmlElement('w:pBdr')
-        bottom_border = OxmlElement('w:bottom')
-        bottom_border.set(qn('w:val'), 'single')  # Single line
-        bottom_border.set(qn('w:sz'), str(width))  # Size of the border, e.g., a value of 4 is 1/2 point
-        bottom_border.set(qn('w:space'), str(space))  # The space above the border, e.g., 1/8 point
-        bottom_border.set(qn('w:color'), color)  # The color of the border
-        p_border.append(bottom_border)
-        p._p.get_or_add_pPr().append(p_border)
\ No newline at end of file
+        p._p.get_or_add_pPr().append(bottom_border_element(color, width, space))
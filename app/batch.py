@@ -0,0 +1,180 @@
+"""
+path: app/batch.py
+
+This file contains the batch pipeline used to generate CVs for a whole team at once.
+"""
+import io
+import os
+import json
+import logging
+import tempfile
+import zipfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from app.asi import scratch_dir
+from app.cache import get_render_cache, get_object_cache
+from app.config import settings
+from app.converter import get_converter_pool, ConversionError, ConversionCancelled
+from app.executor import render_cancelled
+from app.memory import render_memory
+from app.profiles import build_profile_cv, estimate_cost
+from app.pdf import render_pdf
+from app.render import render_key, url_key, upload_render, record_link, resolve_pdf_engine, resolve_pdf_profile
+from app.scheduler import get_render_scheduler
+from app.storage import storage_url
+
+
+logger = logging.getLogger(__name__)
+
+
+def _build(profile):
+    """
+    Builds the CV for one profile and serializes it to docx bytes
+    """
+    asi_cv = build_profile_cv(profile)
+    asi_cv.build_document()
+    docx_bytes = asi_cv.save_docx()
+    # the item keeps the ASI_CV until the batch is done, only its file_id is used from here on
+    asi_cv.release_document()
+    return asi_cv, docx_bytes
+
+
+def _build_native_pdf(profile):
+    """
+    Lays the pdf of one profile out in-process, no docx is built
+    """
+    asi_cv = build_profile_cv(profile)
+    return asi_cv, render_pdf(asi_cv)
+
+
+def _reserved(build, profile):
+    """
+    Runs build(profile) holding the estimated cost of the profile in the memory budget and a render slot
+    """
+    cancel = render_cancelled.get()
+    # reserved per item, the cost of a whole batch could take the budget from every other render,
+    # and a slot per item lets interactive renders take their share of the slots between the items
+    with render_memory(estimate_cost(profile), cancel=cancel), get_render_scheduler().slot(cancel=cancel):
+        return build(profile)
+
+
+def _convert(items, pdf_profile="default"):
+    """
+    Converts the docx bytes of every built item to pdf with as few soffice runs as possible
+    """
+    with tempfile.TemporaryDirectory(prefix="asi-cv-batch-", dir=scratch_dir()) as scratch:
+        docx_paths = []
+        for item in items:
+            docx_path = os.path.join(scratch, item["cv"].file_id + ".docx")
+            with open(docx_path, "wb") as file:
+                file.write(item["bytes"])
+            docx_paths.append(docx_path)
+        error = "The conversion to pdf failed"
+        try:
+            get_converter_pool().convert_many(docx_paths, scratch, pdf_profile=pdf_profile)
+        except ConversionCancelled:
+            raise
+        except ConversionError as e:
+            # the chunks that did convert are still used
+            error = str(e)
+        for item, docx_path in zip(items, docx_paths):
+            pdf_path = os.path.splitext(docx_path)[0] + ".pdf"
+            if not os.path.exists(pdf_path):
+                item["error"] = error
+                continue
+            with open(pdf_path, "rb") as file:
+                item["bytes"] = file.read()
+
+
+def generate_batch(profiles, file_format="pdf", output_type="url", bucket_name=None, folder=None, credentials=None, pdf_engine=None, pdf_profile=None):
+    """
+    Generates a CV for every Profile or RawProfile.
+
+    Documents are built in parallel, converted together and uploaded
+    concurrently. Returns a list with a url or an error per profile when the
+    output type is 'url', or the bytes of a zip archive when it is 'file'.
+    """
+    if file_format not in ["docx", "pdf"]:
+        raise ValueError("The file format should be either 'docx' or 'pdf'")
+    if output_type not in ["url", "file"]:
+        raise ValueError("The output type should be either 'url' or 'file'")
+    if output_type == "url" and (bucket_name is None or folder is None or credentials is None):
+        raise ValueError("The bucket name, folder and credentials should be provided when the output type is 'url'")
+    pdf_engine = resolve_pdf_engine(pdf_engine)
+    pdf_profile = resolve_pdf_profile(pdf_profile)
+    native = file_format == "pdf" and pdf_engine == "native"
+    cache = get_render_cache()
+    objects = get_object_cache()
+    items = []
+    for index, profile in enumerate(profiles):
+        item = {"index": index, "name": profile.Name, "profile": profile, "key": render_key(profile, file_format, pdf_engine, pdf_profile)}
+        if output_type == "url":
+            name = objects.get(url_key(item["key"], bucket_name, folder))
+            if name is not None:
+                item["url"] = storage_url(name.decode("utf-8"), bucket_name, credentials)
+                items.append(item)
+                continue
+        file_bytes = cache.get(item["key"])
+        if file_bytes is not None:
+            item["bytes"] = file_bytes
+        items.append(item)
+    with ThreadPoolExecutor(max_workers=settings.RENDER_WORKERS, thread_name_prefix="asi-batch") as executor:
+        pending = [item for item in items if "url" not in item and "bytes" not in item]
+        build = _build_native_pdf if native else _build
+        futures = [executor.submit(contextvars.copy_context().run, _reserved, build, item["profile"]) for item in pending]
+        for item, future in zip(pending, futures):
+            try:
+                item["cv"], item["bytes"] = future.result()
+            except ConversionCancelled:
+                raise
+            except Exception as e:
+                logger.error("Failed to build the CV of %s: %s", item["name"], e)
+                item["error"] = str(e)
+        built = [item for item in pending if "error" not in item]
+        if file_format == "pdf" and not native and built:
+            _convert(built, pdf_profile)
+        for item in built:
+            if "error" not in item:
+                cache.set(item["key"], item["bytes"])
+                record_link(item["key"], file_format, item["bytes"])
+        if output_type == "url":
+            uploads = [item for item in items if "error" not in item and "url" not in item]
+            futures = [executor.submit(contextvars.copy_context().run, upload_render, item["bytes"], item["profile"], file_format,
+                                       bucket_name, folder, credentials)
+                       for item in uploads]
+            for item, future in zip(uploads, futures):
+                try:
+                    name = future.result()
+                    objects.set(url_key(item["key"], bucket_name, folder), name.encode("utf-8"))
+                    item["url"] = storage_url(name, bucket_name, credentials)
+                except Exception as e:
+                    logger.error("Failed to upload the CV of %s: %s", item["name"], e)
+                    item["error"] = str(e)
+            return [_result(item) for item in items]
+    return _archive(items, file_format)
+
+
+def _result(item):
+    result = {"index": item["index"], "name": item["name"]}
+    if "error" in item:
+        result["error"] = item["error"]
+    else:
+        result["url"] = item["url"]
+    return result
+
+
+def _archive(items, file_format):
+    """
+    Packs the generated files into a zip, failures are listed in errors.json
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for item in items:
+            if "error" in item:
+                continue
+            archive.writestr(f"{item['index'] + 1:03d} {item['name']} ASI CV Export.{file_format}", item["bytes"])
+        errors = [_result(item) for item in items if "error" in item]
+        if errors:
+            archive.writestr("errors.json", json.dumps(errors, indent=2))
+    return buffer.getvalue()
@@ -0,0 +1,239 @@
+"""
+path: app/bulk.py
+
+This file contains the bulk import of newline delimited RawProfile exports. Records
+are parsed, rendered and uploaded with bounded concurrency and a result is
+produced per record as soon as it is done, so memory does not grow with the import.
+Every import of the process shares one pool of BULK_CONCURRENCY threads and at
+most BULK_IMPORTS imports are streamed at once.
+
+    python -m app.bulk export.ndjson --output results.ndjson
+    cat export.ndjson | python -m app.bulk - --file-format docx
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pydantic import ValidationError
+
+from app.config import settings
+from app.converter import PDF_PROFILES, shutdown_converter_pool
+from app.executor import RenderQueueFull
+from app.memory import render_memory, MemoryBudgetExhausted
+from app.metrics import registry, Counter, Gauge
+from app.parser import ProfileParseError
+from app.profiles import estimate_cost
+from app.render import render_profile
+from app.scheduler import BULK, render_priority, render_client, get_render_scheduler
+from app.schema import RawProfile
+
+
+logger = logging.getLogger(__name__)
+
+BULK_RECORDS = registry.register(Counter("asi_bulk_records_total", "Bulk import records by result"))
+
+
+def validation_error(error):
+    """
+    Returns the field level errors of a ValidationError on one line
+    """
+    return "; ".join(f"{'.'.join(str(part) for part in item['loc']) or 'record'}: {item['msg']}" for item in error.errors())
+
+
+def render_record(profile, line_number, **kwargs):
+    """
+    Renders a record once the memory budget has room for it and the render scheduler gives it a slot,
+    a bulk import waits for as long as that takes
+    """
+    cost = estimate_cost(profile)
+    while True:
+        try:
+            # memory first, like RenderExecutor, so a record waiting for room does not hold a render slot
+            with render_memory(cost), get_render_scheduler().slot():
+                return render_profile(profile, **kwargs)
+        except MemoryBudgetExhausted:
+            logger.info("The memory budget is full, line %s waits for room again", line_number)
+
+
+def import_record(line_number, line, file_format="pdf", bucket_name=None, folder=None, credentials=None, pdf_engine=None, priority=BULK, pdf_profile=None, client=None):
+    """
+    Parses, renders and uploads one NDJSON record and returns its result
+    """
+    # every record runs in a context of its own, it waits for a render slot and a LibreOffice worker in this class
+    render_priority.set(priority)
+    render_client.set(client)
+    try:
+        profile = RawProfile.model_validate_json(line)
+    except ValidationError as e:
+        BULK_RECORDS.inc(result="invalid")
+        return {"line": line_number, "error": validation_error(e)}
+    try:
+        url = render_record(profile, line_number, file_format=file_format, output_type="url", bucket_name=bucket_name,
+                            folder=folder, credentials=credentials, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
+    except ProfileParseError as e:
+        BULK_RECORDS.inc(result="invalid")
+        return {"line": line_number, "name": profile.Name, "error": str(e)}
+    except Exception as e:
+        logger.error("Failed to import the CV of %s on line %s: %s", profile.Name, line_number, e)
+        BULK_RECORDS.inc(result="failed")
+        return {"line": line_number, "name": profile.Name, "error": str(e)}
+    BULK_RECORDS.inc(result="done")
+    return {"line": line_number, "name": profile.Name, "url": url}
+
+
+class BulkExecutor:
+    """
+    Runs the records of every bulk import on one thread pool and rejects an
+    import with RenderQueueFull once max_imports imports are already running,
+    so concurrent imports share max_workers threads instead of each starting its own.
+    """
+    def __init__(self, max_workers=8, max_imports=4):
+        self.max_workers = max_workers
+        self.max_imports = max_imports
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="asi-bulk")
+        self._running = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running
+
+    def admit(self):
+        """
+        Admits an import and returns the function that ends it, which may be called more than once
+        """
+        with self._lock:
+            if self._running >= self.max_imports:
+                raise RenderQueueFull(f"{self._running} bulk imports are already running, try again later")
+            self._running += 1
+        released = threading.Event()
+
+        def release():
+            with self._lock:
+                if not released.is_set():
+                    released.set()
+                    self._running -= 1
+        return release
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_bulk_executor = None
+_bulk_executor_lock = threading.Lock()
+
+
+def get_bulk_executor():
+    """
+    Returns the process wide bulk executor, creating it on first use
+    """
+    global _bulk_executor
+    if _bulk_executor is None:
+        with _bulk_executor_lock:
+            if _bulk_executor is None:
+                _bulk_executor = BulkExecutor(max_workers=settings.BULK_CONCURRENCY, max_imports=settings.BULK_IMPORTS)
+    return _bulk_executor
+
+
+registry.register(Gauge("asi_bulk_imports_running", "Bulk imports running on the bulk executor",
+                        function=lambda: _bulk_executor.running if _bulk_executor is not None else 0))
+
+
+def shutdown_bulk_executor():
+    global _bulk_executor
+    with _bulk_executor_lock:
+        if _bulk_executor is not None:
+            _bulk_executor.shutdown()
+            _bulk_executor = None
+
+
+def import_lines(lines, file_format="pdf", bucket_name=None, folder=None, credentials=None, pdf_engine=None, concurrency=None, priority=BULK, pdf_profile=None, executor=None, client=None):
+    """
+    Yields the result of every non-empty line in completion order.
+
+    Lines are only read while fewer than `concurrency` records are in flight,
+    so any iterable of lines, including an open file, is consumed incrementally.
+    Records run on executor, the process wide bulk executor by default.
+    """
+    concurrency = concurrency or settings.BULK_CONCURRENCY
+    executor = executor or get_bulk_executor()
+    pending = set()
+    try:
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(contextvars.copy_context().run, import_record, line_number, line, file_format,
+                                        bucket_name, folder, credentials, pdf_engine, priority, pdf_profile, client))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # the consumer went away (e.g. the client disconnected), drop what has not started
+        for future in pending:
+            future.cancel()
+
+
+def stream_import(file, release=None, **kwargs):
+    """
+    Yields the results of an import from an open file as NDJSON lines, closes the file and ends the admitted import
+    """
+    try:
+        with file:
+            for result in import_lines(file, **kwargs):
+                yield json.dumps(result) + "\n"
+    finally:
+        if release is not None:
+            release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="NDJSON file of RawProfile records, - for stdin")
+    parser.add_argument("--output", help="write the results as NDJSON to this file instead of stdout")
+    parser.add_argument("--file-format", default="pdf", choices=["pdf", "docx"])
+    parser.add_argument("--pdf-engine", choices=["libreoffice", "native"])
+    parser.add_argument("--pdf-profile", choices=list(PDF_PROFILES))
+    parser.add_argument("--concurrency", type=int, default=settings.BULK_CONCURRENCY)
+    parser.add_argument("--folder", default=settings.BUCKET_FOLDER)
+    args = parser.parse_args()
+    source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    target = open(args.output, "w") if args.output else sys.stdout
+    counts = {"url": 0, "error": 0}
+    started = time.perf_counter()
+    # the command line import is the only one of its process and gets a pool of its own size
+    executor = BulkExecutor(max_workers=args.concurrency, max_imports=1)
+    try:
+        for result in import_lines(source, file_format=args.file_format, bucket_name=settings.BUCKET_NAME, folder=args.folder,
+                                   credentials=settings.CREDENTIALS, pdf_engine=args.pdf_engine, concurrency=args.concurrency,
+                                   pdf_profile=args.pdf_profile, executor=executor):
+            counts["error" if "error" in result else "url"] += 1
+            target.write(json.dumps(result) + "\n")
+            target.flush()
+    finally:
+        source.close()
+        if target is not sys.stdout:
+            target.close()
+        executor.shutdown()
+        shutdown_converter_pool()
+    elapsed = time.perf_counter() - started
+    total = counts["url"] + counts["error"]
+    print(f"{total} records in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f}/s), "
+          f"{counts['url']} uploaded, {counts['error']} failed", file=sys.stderr)
+    sys.exit(1 if counts["error"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+path: app/cache.py
+
+This file contains the content addressed cache of rendered CVs and the caches
+of the uploaded object names and serialized document sections.
+"""
+import io
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from app.config import settings
+from app.metrics import CACHE_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+# entries being written are named with this prefix until they are complete
+TEMPORARY_PREFIX = ".tmp-"
+# the share of disk_size a process writes before it counts the directory again
+RESCAN_FRACTION = 1 / 16
+
+
+def canonical_hash(*parts):
+    """
+    Hashes json serializable parts independently of dict ordering and whitespace
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    A two tier bytes cache: an in-memory LRU in front of a directory on disk.
+
+    Both tiers are bounded in bytes. The disk tier evicts the least recently
+    used files, using the modification time that is bumped on every hit. The
+    directory may be shared by several processes, so its size is counted
+    again from the files before evicting and after every RESCAN_FRACTION of
+    disk_size written by this process.
+    """
+    def __init__(self, memory_size=64 * 1024 * 1024, disk_dir=None, disk_size=512 * 1024 * 1024, name="render"):
+        self.name = name
+        self.memory_size = memory_size
+        self.disk_dir = disk_dir
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir and self.disk_size > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_entries(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.startswith(TEMPORARY_PREFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """
+        Returns the cached bytes for key or None
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return value
+        value = self._get_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="miss")
+                return None
+            self.hits += 1
+        CACHE_REQUESTS.inc(cache=self.name, result="hit")
+        self._set_memory(key, value)
+        return value
+
+    def set(self, key, value):
+        self._set_memory(key, value)
+        self._set_disk(key, value)
+
+    def get_file(self, key):
+        """
+        Returns the cached entry as an open binary file or None.
+
+        Entries too large for the memory tier are streamed from disk instead of
+        being read into memory.
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return io.BytesIO(value)
+        if self.disk_dir and self.disk_size > 0:
+            path = self._path(key)
+            try:
+                if os.path.getsize(path) > self.memory_size:
+                    file = open(path, "rb")
+                    os.utime(path)
+                    with self._lock:
+                        self.hits += 1
+                    CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                    return file
+            except FileNotFoundError:
+                pass
+        value = self.get(key)
+        return io.BytesIO(value) if value is not None else None
+
+    def set_file(self, key, file):
+        """
+        Caches the content of a seekable binary file and rewinds it, returns whether a tier kept it
+        """
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        stored = False
+        if size <= self.memory_size:
+            self.set(key, file.read())
+            stored = True
+        elif self.disk_dir and 0 < size <= self.disk_size:
+            self._write_disk(key, size, lambda target: shutil.copyfileobj(file, target))
+            stored = True
+        file.seek(0)
+        return stored
+
+    def contains(self, key):
+        """
+        Returns whether key is cached, without reading the entry
+        """
+        with self._lock:
+            if key in self._memory:
+                return True
+        return bool(self.disk_dir) and self.disk_size > 0 and os.path.exists(self._path(key))
+
+    def delete(self, key):
+        """
+        Removes key from both tiers, the disk tier never replaces an entry that is already written
+        """
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+        if self.disk_dir and self.disk_size > 0:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """
+        Empties the memory tier
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def _set_memory(self, key, value):
+        if len(value) > self.memory_size:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+            while self._memory_bytes > self.memory_size:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _get_disk(self, key):
+        if not self.disk_dir or self.disk_size <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                value = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def _set_disk(self, key, value):
+        if not self.disk_dir or self.disk_size <= 0 or len(value) > self.disk_size:
+            return
+        self._write_disk(key, len(value), lambda target: target.write(value))
+
+    def _write_disk(self, key, size, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            return
+        # write to a temporary file first so readers never see a partial entry
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMPORARY_PREFIX)
+        with os.fdopen(descriptor, "wb") as file:
+            write(file)
+        os.replace(temporary, path)
+        with self._lock:
+            self._disk_bytes += size
+            self._written += size
+            # the other processes writing to the directory are only seen by counting it
+            rescan = self._disk_bytes > self.disk_size or self._written > self.disk_size * RESCAN_FRACTION
+        if rescan:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """
+        Counts the files of the disk tier and removes the least recently used until it is back under 90% of its size
+        """
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_size * 0.9
+        if total > self.disk_size:
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # evicted by another process meanwhile
+                    pass
+                total -= size
+        with self._lock:
+            self._disk_bytes = total
+            self._written = 0
+
+
+_cache = None
+_object_cache = None
+_fragment_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """
+    Returns the process wide render cache, creating it on first use
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RenderCache(memory_size=settings.CACHE_MEMORY_SIZE,
+                                     disk_dir=settings.CACHE_DIR,
+                                     disk_size=settings.CACHE_DISK_SIZE)
+    return _cache
+
+
+def get_object_cache():
+    """
+    Returns the process wide cache of the storage object names renders were uploaded to, kept apart from the renders
+    """
+    global _object_cache
+    if _object_cache is None:
+        with _cache_lock:
+            if _object_cache is None:
+                _object_cache = RenderCache(memory_size=settings.OBJECT_CACHE_SIZE,
+                                            disk_dir=settings.OBJECT_CACHE_DIR,
+                                            disk_size=settings.OBJECT_CACHE_SIZE, name="object")
+    return _object_cache
+
+
+def get_fragment_cache():
+    """
+    Returns the process wide cache of serialized document sections, kept in memory only
+    """
+    global _fragment_cache
+    if _fragment_cache is None:
+        with _cache_lock:
+            if _fragment_cache is None:
+                _fragment_cache = RenderCache(memory_size=settings.FRAGMENT_CACHE_SIZE, disk_size=0, name="fragment")
+    return _fragment_cache
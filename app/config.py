@@ -17,10 +17,58 @@ class Settings(BaseSettings):
     BUCKET_NAME: str = os.getenv('BUCKET_NAME', "recombo-vision")
     BUCKET_FOLDER: str = os.getenv('BUCKET_FOLDER', "asi-cvs")
     CREDENTIALS: str = os.getenv('CREDENTIALS', "credentials.json")
+    STORAGE_BACKEND: str = os.getenv('STORAGE_BACKEND', "gcs")
+    SIGNED_URLS: bool = os.getenv('SIGNED_URLS', False)
+    SIGNED_URL_EXPIRY: int = os.getenv('SIGNED_URL_EXPIRY', 7 * 24 * 60 * 60)
+    LOCAL_STORAGE_DIR: str = os.getenv('LOCAL_STORAGE_DIR', "")
+    PUBLIC_URL: str = os.getenv('PUBLIC_URL', "")
     TEMPLATES_DIR: str = os.getenv('TEMPLATES_DIR', "templates")
     OUTPUT_DIR: str = os.getenv('OUTPUT_DIR', "output")
     PORT: int = os.getenv('PORT', 8000)
     PROJECT_NAME: str = os.getenv('PROJECT_NAME', "ASI CV Generator")
+    WEB_WORKERS: int = os.getenv('WEB_WORKERS', 0)
+    WEB_TIMEOUT: int = os.getenv('WEB_TIMEOUT', 120)
+    WARMUP: bool = os.getenv('WARMUP', True)
+    METRICS_DIR: str = os.getenv('METRICS_DIR', "")
+    METRICS_INTERVAL: float = os.getenv('METRICS_INTERVAL', 5)
+    LIBREOFFICE_BINARY: str = os.getenv('LIBREOFFICE_BINARY', "libreoffice")
+    CONVERTER_POOL_SIZE: int = os.getenv('CONVERTER_POOL_SIZE', 2)
+    CONVERTER_BASE_PORT: int = os.getenv('CONVERTER_BASE_PORT', 2002)
+    CONVERTER_MAX_JOBS: int = os.getenv('CONVERTER_MAX_JOBS', 50)
+    CONVERSION_TIMEOUT: int = os.getenv('CONVERSION_TIMEOUT', 60)
+    PDF_ENGINE: str = os.getenv('PDF_ENGINE', "libreoffice")
+    PDF_PROFILE: str = os.getenv('PDF_PROFILE', "default")
+    PDF_FONT: str = os.getenv('PDF_FONT', "")
+    PDF_FONT_BOLD: str = os.getenv('PDF_FONT_BOLD', "")
+    SCRATCH_DIR: str = os.getenv('SCRATCH_DIR', "")
+    SPOOL_MAX_SIZE: int = os.getenv('SPOOL_MAX_SIZE', 1024 * 1024)
+    STREAM_UPLOAD_THRESHOLD: int = os.getenv('STREAM_UPLOAD_THRESHOLD', 8 * 1024 * 1024)
+    UPLOAD_CHUNK_SIZE: int = os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    RENDER_WORKERS: int = os.getenv('RENDER_WORKERS', 4)
+    RENDER_QUEUE_SIZE: int = os.getenv('RENDER_QUEUE_SIZE', 16)
+    PRIORITY_WEIGHTS: str = os.getenv('PRIORITY_WEIGHTS', "interactive:4,bulk:1")
+    API_KEY_PRIORITIES: str = os.getenv('API_KEY_PRIORITIES', "")
+    CLIENT_CONCURRENCY: int = os.getenv('CLIENT_CONCURRENCY', 0)
+    CONVERT_CHUNK_SIZE: int = os.getenv('CONVERT_CHUNK_SIZE', 4)
+    RENDER_MEMORY_BUDGET: int = os.getenv('RENDER_MEMORY_BUDGET', 256 * 1024 * 1024)
+    RENDER_MEMORY_WAIT: int = os.getenv('RENDER_MEMORY_WAIT', 30)
+    TRACE_MEMORY: bool = os.getenv('TRACE_MEMORY', False)
+    TRACE_MEMORY_INTERVAL: float = os.getenv('TRACE_MEMORY_INTERVAL', 0.01)
+    BULK_CONCURRENCY: int = os.getenv('BULK_CONCURRENCY', 8)
+    BULK_IMPORTS: int = os.getenv('BULK_IMPORTS', 4)
+    CACHE_DIR: str = os.getenv('CACHE_DIR', "output/cache")
+    CACHE_MEMORY_SIZE: int = os.getenv('CACHE_MEMORY_SIZE', 64 * 1024 * 1024)
+    CACHE_DISK_SIZE: int = os.getenv('CACHE_DISK_SIZE', 512 * 1024 * 1024)
+    OBJECT_CACHE_DIR: str = os.getenv('OBJECT_CACHE_DIR', "output/objects")
+    OBJECT_CACHE_SIZE: int = os.getenv('OBJECT_CACHE_SIZE', 16 * 1024 * 1024)
+    FRAGMENT_CACHE_SIZE: int = os.getenv('FRAGMENT_CACHE_SIZE', 16 * 1024 * 1024)
+    CV_MAX_AGE: int = os.getenv('CV_MAX_AGE', 24 * 60 * 60)
+    LOCK_DIR: str = os.getenv('LOCK_DIR', "output/locks")
+    SINGLE_FLIGHT_TIMEOUT: int = os.getenv('SINGLE_FLIGHT_TIMEOUT', 120)
+    JOB_DB: str = os.getenv('JOB_DB', "output/jobs.sqlite3")
+    JOB_WORKERS: int = os.getenv('JOB_WORKERS', 1)
+    JOB_POLL_INTERVAL: float = os.getenv('JOB_POLL_INTERVAL', 0.5)
+    JOB_RETENTION: int = os.getenv('JOB_RETENTION', 24 * 60 * 60)
     class Config:
         """
         Config class to load environment variables from .env file
@@ -0,0 +1,430 @@
+"""
+path: app/converter.py
+
+This file contains a pool of long-lived headless LibreOffice instances used to
+convert docx files to pdf without paying the soffice cold start on every request.
+"""
+import os
+import sys
+import time
+import queue
+import shutil
+import socket
+import contextvars
+import logging
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import settings
+from app.executor import render_cancelled
+from app.metrics import registry, stage, Gauge, Histogram, CONVERSION_QUEUE_DEPTH, CONVERSION_FAILURES
+from app.scheduler import PriorityScheduler, BULK, priority_weights, render_priority
+from app.utils import (ConversionError, ConversionTimeout, ConversionCancelled, convert_docx_to_pdf,
+                       convert_docx_files_to_pdf, kill_process_group)
+
+try:
+    # pyuno ships with LibreOffice (python3-uno on debian), it is not on pypi
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+
+logger = logging.getLogger(__name__)
+
+# writer_pdf_Export filter options of each pdf export profile, LibreOffice subsets the fonts it embeds in all of them
+PDF_PROFILES = {
+    "default": {},
+    "web-compact": {
+        "ExportBookmarks": False,
+        "UseTaggedPDF": False,
+        "ExportNotes": False,
+        "EmbedStandardFonts": False,
+        "UseLosslessCompression": False,
+        "Quality": 75,
+        "ReduceImageResolution": True,
+        "MaxImageResolution": 150,
+    },
+    "archival": {
+        # PDF/A-2b, which embeds every font and leaves out anything that depends on the viewer
+        "SelectPdfVersion": 2,
+        "UseTaggedPDF": True,
+        "ExportBookmarks": True,
+    },
+}
+
+PDF_OUTPUT_BYTES = registry.register(Histogram("asi_pdf_output_bytes", "Size of the pdfs LibreOffice wrote by export profile",
+                                               buckets=tuple(2 ** power * 1024 for power in range(3, 15))))
+PDF_CONVERSION_SECONDS = registry.register(Histogram("asi_pdf_conversion_seconds", "Time spent converting a docx to pdf by export profile, waiting for a worker included"))
+
+
+def _properties(**kwargs):
+    """
+    Builds a tuple of UNO PropertyValue from keyword arguments
+    """
+    properties = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        properties.append(prop)
+    return tuple(properties)
+
+
+class LibreOfficeWorker:
+    """
+    A single headless LibreOffice instance with its own user profile.
+
+    When pyuno is available the instance is kept running with a socket listener
+    and documents are converted over UNO. Otherwise every job runs a one-shot
+    soffice against the private, already initialised profile of this worker.
+    """
+    def __init__(self, index, port, binary="libreoffice", max_jobs=50, startup_timeout=30):
+        self.index = index
+        self.port = port
+        self.binary = binary
+        self.max_jobs = max_jobs
+        self.startup_timeout = startup_timeout
+        self.profile_dir = tempfile.mkdtemp(prefix=f"asi-lo-profile-{index}-")
+        self.process = None
+        self.desktop = None
+        self.jobs = 0
+        self.interrupted = None
+
+    @property
+    def profile_url(self):
+        return Path(self.profile_dir).as_uri()
+
+    @property
+    def listening(self):
+        return uno is not None
+
+    def start(self):
+        """
+        Starts the soffice listener and waits until it accepts connections
+        """
+        self.jobs = 0
+        if not self.listening:
+            return
+        command = [
+            self.binary,
+            f"-env:UserInstallation={self.profile_url}",
+            "--headless", "--invisible", "--nologo", "--nodefault", "--norestore", "--nolockcheck",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+        ]
+        logger.info("Starting LibreOffice worker %s on port %s", self.index, self.port)
+        # a session of its own so the launcher and every soffice it starts are killed together
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                self.desktop = self._connect()
+                return
+            except Exception:
+                time.sleep(0.25)
+        self.stop()
+        raise RuntimeError(f"LibreOffice worker {self.index} did not start within {self.startup_timeout}s")
+
+    def _connect(self):
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context)
+        context = resolver.resolve(
+            f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+        return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+    def stop(self):
+        self.desktop = None
+        process, self.process = self.process, None
+        if process is not None:
+            kill_process_group(process)
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def refresh(self):
+        """
+        Drops the instance and its profile after a failure, the next job starts from scratch
+        """
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.profile_dir = tempfile.mkdtemp(prefix=f"asi-lo-profile-{self.index}-")
+
+    def is_healthy(self):
+        """
+        Checks that the listener process is alive and its port is open
+        """
+        if not self.listening:
+            return True
+        if self.process is None or self.process.poll() is not None or self.desktop is None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def needs_recycle(self):
+        return self.jobs >= self.max_jobs
+
+    def _watch(self, deadline, cancel, done):
+        """
+        Kills the instance when the deadline passes or the job is cancelled, the UNO call in progress then raises
+        """
+        while not done.wait(0.1):
+            if cancel is not None and cancel.is_set():
+                self.interrupted = ConversionCancelled("The conversion to pdf was cancelled")
+            elif deadline is not None and time.monotonic() >= deadline:
+                self.interrupted = ConversionTimeout("The conversion to pdf timed out")
+            else:
+                continue
+            self.stop()
+            return
+
+    def _convert_uno(self, docx_path, pdf_path, filter_options=None):
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(docx_path)), "_blank", 0, _properties(Hidden=True))
+        properties = {"FilterName": "writer_pdf_Export"}
+        if filter_options:
+            properties["FilterData"] = uno.Any("[]com.sun.star.beans.PropertyValue", _properties(**filter_options))
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(pdf_path)), _properties(**properties))
+        finally:
+            document.close(True)
+
+    def convert(self, docx_path, pdf_path, deadline=None, cancel=None, filter_options=None):
+        """
+        Converts docx_path into pdf_path before the monotonic deadline, raises ConversionError otherwise
+        """
+        self.jobs += 1
+        if not self.listening:
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            convert_docx_to_pdf(docx_path, pdf_path, profile_dir=self.profile_dir, timeout=timeout,
+                                binary=self.binary, cancel=cancel, filter_options=filter_options)
+            return
+        self.interrupted = None
+        done = threading.Event()
+        watcher = threading.Thread(target=self._watch, args=(deadline, cancel, done), daemon=True)
+        watcher.start()
+        try:
+            self._convert_uno(docx_path, pdf_path, filter_options)
+        except Exception as e:
+            raise self.interrupted or ConversionError(f"LibreOffice worker {self.index} failed to convert: {e}")
+        finally:
+            done.set()
+            watcher.join()
+        if self.interrupted is not None:
+            raise self.interrupted
+        if not os.path.exists(pdf_path):
+            raise ConversionError(f"LibreOffice did not write {os.path.basename(pdf_path)}")
+
+    def convert_many(self, docx_paths, outdir, deadline=None, cancel=None, filter_options=None):
+        """
+        Converts every docx file into outdir before the monotonic deadline, raises ConversionError otherwise
+        """
+        if not self.listening:
+            self.jobs += len(docx_paths)
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            convert_docx_files_to_pdf(docx_paths, outdir, profile_dir=self.profile_dir, timeout=timeout,
+                                      binary=self.binary, cancel=cancel, filter_options=filter_options)
+            return
+        for docx_path in docx_paths:
+            pdf_path = os.path.join(outdir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+            if not self.is_healthy():
+                self.restart()
+            self.convert(docx_path, pdf_path, deadline=deadline, cancel=cancel, filter_options=filter_options)
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class ConverterPool:
+    """
+    A fixed size pool of LibreOffice workers.
+
+    Workers are started lazily, health checked before every job and recycled
+    after max_jobs conversions. Every job has a deadline of timeout seconds,
+    covering the wait for a worker. A job that fails is retried once on a
+    fresh instance if its deadline allows, and a job is abandoned as soon as
+    the client that asked for it disconnects. Waiting jobs get the workers
+    in the weighted fair shares of their priority classes.
+    """
+    def __init__(self, size=2, binary="libreoffice", base_port=2002, max_jobs=50, timeout=60, chunk_size=0):
+        self.size = size
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._scheduler = PriorityScheduler(size, priority_weights(), name="convert")
+        if uno is None:
+            logger.error("pyuno can not be imported by %s, the LibreOffice pool is degraded to one-shot mode: every "
+                         "conversion starts a new soffice. Install python3-uno for this interpreter (the Docker image does)",
+                         sys.executable)
+        self._idle = queue.Queue()
+        self._workers = []
+        for index in range(size):
+            worker = LibreOfficeWorker(index, base_port + index, binary=binary, max_jobs=max_jobs)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def _checkout(self, deadline, cancel, priority):
+        """
+        Waits for a worker until the deadline, giving up early when the job is cancelled
+        """
+        CONVERSION_QUEUE_DEPTH.inc()
+        try:
+            if not self._scheduler.acquire(priority, deadline=deadline, cancel=cancel):
+                if cancel is not None and cancel.is_set():
+                    CONVERSION_FAILURES.inc(reason="cancelled")
+                    raise ConversionCancelled("The conversion to pdf was cancelled")
+                logger.error("No LibreOffice worker became available within %ss", self.timeout)
+                CONVERSION_FAILURES.inc(reason="unavailable")
+                raise ConversionTimeout("No LibreOffice worker became available in time")
+            # the scheduler grants one slot per worker, a worker is idle for every slot granted
+            return self._idle.get_nowait()
+        finally:
+            CONVERSION_QUEUE_DEPTH.dec()
+
+    def _run(self, job, timeout, cancel=None, priority=None):
+        """
+        Runs job(worker, deadline, cancel) on the next idle worker, raises ConversionError when it fails twice
+        """
+        if cancel is None:
+            cancel = render_cancelled.get()
+        priority = priority or render_priority.get()
+        deadline = time.monotonic() + timeout
+        for attempt in range(2):
+            worker = self._checkout(deadline, cancel, priority)
+            try:
+                if not worker.is_healthy() or worker.needs_recycle():
+                    worker.restart()
+                with stage("convert"):
+                    job(worker, deadline, cancel)
+                return
+            except ConversionCancelled:
+                CONVERSION_FAILURES.inc(reason="cancelled")
+                worker.stop()
+                raise
+            except ConversionTimeout:
+                logger.error("LibreOffice worker %s timed out after %ss", worker.index, timeout)
+                CONVERSION_FAILURES.inc(reason="timeout")
+                worker.refresh()
+                raise
+            except Exception as e:
+                logger.error("LibreOffice worker %s failed: %s", worker.index, e)
+                CONVERSION_FAILURES.inc(reason="error" if isinstance(e, ConversionError) else "crash")
+                worker.refresh()
+                if attempt or time.monotonic() >= deadline:
+                    if isinstance(e, ConversionError):
+                        raise
+                    raise ConversionError(f"LibreOffice worker {worker.index} crashed: {e}") from e
+                logger.info("Retrying the conversion on a fresh LibreOffice instance")
+            finally:
+                self._idle.put(worker)
+                self._scheduler.release()
+
+    def convert(self, docx_path, pdf_path, cancel=None, pdf_profile="default"):
+        """
+        Converts docx_path into pdf_path with the options of pdf_profile on the next idle worker,
+        raises ConversionError when it can not
+        """
+        filter_options = PDF_PROFILES[pdf_profile]
+        start = time.perf_counter()
+        self._run(lambda worker, deadline, cancel: worker.convert(docx_path, pdf_path, deadline=deadline, cancel=cancel,
+                                                                  filter_options=filter_options),
+                  self.timeout, cancel=cancel)
+        _record(pdf_profile, [pdf_path], time.perf_counter() - start)
+
+    def convert_many(self, docx_paths, outdir, cancel=None, pdf_profile="default"):
+        """
+        Converts a batch of docx files into outdir.
+
+        The files are split into one chunk per worker and each chunk is converted
+        with a single soffice invocation (or a single UNO connection), with
+        timeout seconds per file. Bulk chunks hold at most chunk_size files, so
+        the workers go back to the scheduler between chunks of a large batch.
+        Raises the ConversionError of the first chunk that failed, after every
+        chunk has finished.
+        """
+        priority = render_priority.get()
+        count = self.size
+        if priority == BULK and self.chunk_size:
+            count = max(count, -(-len(docx_paths) // self.chunk_size))
+        chunks = [docx_paths[index::count] for index in range(count)]
+        chunks = [chunk for chunk in chunks if chunk]
+        if not chunks:
+            return
+        if cancel is None:
+            cancel = render_cancelled.get()
+
+        filter_options = PDF_PROFILES[pdf_profile]
+
+        def convert_chunk(chunk):
+            start = time.perf_counter()
+            self._run(lambda worker, deadline, cancel: worker.convert_many(chunk, outdir, deadline=deadline, cancel=cancel,
+                                                                           filter_options=filter_options),
+                      self.timeout * len(chunk), cancel=cancel, priority=priority)
+            _record(pdf_profile, [os.path.join(outdir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf") for docx_path in chunk],
+                    time.perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=min(len(chunks), self.size)) as executor:
+            # each chunk in a copy of the caller's context, so its convert stage and logs belong to the request
+            futures = [executor.submit(contextvars.copy_context().run, convert_chunk, chunk) for chunk in chunks]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.close()
+
+
+registry.register(Gauge("asi_converter_listening", "1 when conversions run on long-lived LibreOffice listeners over UNO, 0 in one-shot mode",
+                        function=lambda: 1 if uno is not None else 0))
+
+
+def _record(pdf_profile, pdf_paths, elapsed):
+    """
+    Records the size of every pdf written and its share of the conversion time under the export profile
+    """
+    sizes = [os.path.getsize(pdf_path) for pdf_path in pdf_paths if os.path.exists(pdf_path)]
+    for size in sizes:
+        PDF_OUTPUT_BYTES.observe(size, profile=pdf_profile)
+        PDF_CONVERSION_SECONDS.observe(elapsed / len(sizes), profile=pdf_profile)
+    if len(sizes) == 1:
+        logger.info("Converted to a %.1fKiB pdf with the %s profile in %.2fs", sizes[0] / 1024, pdf_profile, elapsed)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_converter_pool():
+    """
+    Returns the process wide converter pool, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConverterPool(
+                    size=settings.CONVERTER_POOL_SIZE,
+                    binary=settings.LIBREOFFICE_BINARY,
+                    base_port=settings.CONVERTER_BASE_PORT,
+                    max_jobs=settings.CONVERTER_MAX_JOBS,
+                    timeout=settings.CONVERSION_TIMEOUT,
+                    chunk_size=settings.CONVERT_CHUNK_SIZE,
+                )
+    return _pool
+
+
+def shutdown_converter_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
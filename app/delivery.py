@@ -0,0 +1,110 @@
+"""
+path: app/delivery.py
+
+This file contains the HTTP caching of the stable CV urls: strong ETags from the
+sha256 of the render, conditional GETs answered with a 304 and single byte range requests.
+"""
+import os
+import re
+
+from starlette.responses import Response, StreamingResponse
+
+
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    Raised when a byte range starts past the end of the file
+    """
+
+
+def digest_etag(digest):
+    """
+    Returns the strong ETag of a render from the sha256 taken when it was cached, so the file is never read for it
+    """
+    return f'"{digest}"'
+
+
+def etag_matches(header, etag):
+    """
+    Returns whether an If-None-Match header lists etag, compared weakly as RFC 9110 asks for it
+    """
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in header.split(","))
+
+
+def if_range_matches(header, etag):
+    """
+    Returns whether an If-Range header is the current strong etag, a date or a weak tag never is
+    """
+    return not etag.startswith("W/") and header.strip() == etag
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) of a single byte range, end included, or None to send the whole file.
+
+    Multiple ranges and malformed headers are ignored, the whole file is a valid answer to both.
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # a suffix range, the last bytes of the file
+        if int(last) == 0:
+            raise RangeNotSatisfiable(header)
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last != "" else size - 1
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    if end < start:
+        return None
+    return start, end
+
+
+def iter_range(file, start, length, chunk_size=64 * 1024):
+    """
+    Yields length bytes of a binary file from start in chunks and closes it
+    """
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def artifact_response(file, media_type, headers, cache_control, etag):
+    """
+    Returns the response to a GET of a rendered file: a 304 when the client has it, part of it for a range or all of it.
+
+    headers are the request headers, the open file is closed once it is sent.
+    """
+    response_headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        file.close()
+        return Response(status_code=304, headers=response_headers)
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    byte_range = None
+    # a range conditional on a copy that is no longer current gets the whole file
+    if "range" in headers and if_range_matches(headers.get("if-range", etag), etag):
+        try:
+            byte_range = parse_range(headers["range"], size)
+        except RangeNotSatisfiable:
+            file.close()
+            return Response(status_code=416, headers=dict(response_headers, **{"Content-Range": f"bytes */{size}"}))
+    if byte_range is None:
+        return StreamingResponse(iter_range(file, 0, size), media_type=media_type,
+                                 headers=dict(response_headers, **{"Content-Length": str(size)}))
+    start, end = byte_range
+    return StreamingResponse(iter_range(file, start, end - start + 1), status_code=206, media_type=media_type,
+                             headers=dict(response_headers, **{"Content-Length": str(end - start + 1),
+                                                                "Content-Range": f"bytes {start}-{end}/{size}"}))
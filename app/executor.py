@@ -0,0 +1,145 @@
+"""
+path: app/executor.py
+
+This file contains the bounded executor used to run CV renders off the event loop.
+"""
+import asyncio
+import functools
+import contextvars
+import logging
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import settings
+from app.memory import render_memory, MemoryBudgetExhausted
+from app.metrics import registry, Gauge
+from app.scheduler import PRIORITY_CLASSES, INTERACTIVE, render_priority, render_client, get_render_scheduler
+
+
+logger = logging.getLogger(__name__)
+
+# the threading.Event of the render running in this context, set once its client has disconnected
+render_cancelled = contextvars.ContextVar("render_cancelled", default=None)
+
+
+class RenderQueueFull(Exception):
+    """
+    Raised when a render is submitted while every worker is busy and the queue is full
+    """
+
+
+class RenderExecutor:
+    """
+    Runs blocking render work (python-docx building, LibreOffice conversion and
+    uploads) on a thread pool and rejects work of a priority class once
+    max_workers renders of that class are running and max_queue more are
+    waiting, so a full bulk queue does not turn exports away. Which of the
+    admitted renders take the max_workers slots is up to the render scheduler.
+    A render given an estimated cost also waits for room in the memory budget
+    before it starts. Work that takes render slots of its own, like a batch
+    taking one per item, runs with scheduled=False.
+
+    Threads are enough here: the conversion itself runs inside the LibreOffice
+    worker processes and uploads are network bound, so neither holds the GIL.
+    """
+    def __init__(self, max_workers=4, max_queue=16):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # a thread for every render admitted, the scheduler decides which of them run
+        self._executor = ThreadPoolExecutor(max_workers=(max_workers + max_queue) * len(PRIORITY_CLASSES), thread_name_prefix="asi-render")
+        self._pending = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return sum(self._pending.values())
+
+    def _acquire(self, priority):
+        with self._lock:
+            if self._pending[priority] >= self.max_workers + self.max_queue:
+                raise RenderQueueFull(f"{self._pending[priority]} {priority} renders are already in flight, try again later")
+            self._pending[priority] += 1
+
+    def _release(self, priority):
+        with self._lock:
+            self._pending[priority] -= 1
+
+    async def run(self, func, *args, cost=0, priority=INTERACTIVE, client=None, scheduled=True, **kwargs):
+        """
+        Runs func(*args, **kwargs) on the pool and waits for the result without blocking the loop,
+        in a render slot of the priority class and holding cost bytes of the memory budget while it runs
+        """
+        self._acquire(priority)
+        try:
+            loop = asyncio.get_running_loop()
+            # run_in_executor does not carry the context over, the stage timers need the request's
+            context = contextvars.copy_context()
+            context.run(render_priority.set, priority)
+            context.run(render_client.set, client)
+            return await loop.run_in_executor(self._executor, functools.partial(context.run, self._call, cost, scheduled, func, args, kwargs))
+        finally:
+            self._release(priority)
+
+    def _call(self, cost, scheduled, func, args, kwargs):
+        cancel = render_cancelled.get()
+        try:
+            # memory first, a render waiting for room in the budget must not hold a render slot meanwhile
+            with render_memory(cost, cancel=cancel), get_render_scheduler().slot(cancel=cancel) if scheduled else nullcontext():
+                return func(*args, **kwargs)
+        except MemoryBudgetExhausted as e:
+            raise RenderQueueFull(str(e))
+
+    async def run_for(self, request, func, *args, cost=0, priority=INTERACTIVE, client=None, scheduled=True, **kwargs):
+        """
+        Runs func like run and sets render_cancelled for it when the client of request disconnects.
+
+        The request body must already be read, the next message received is then the disconnect.
+        """
+        cancel = threading.Event()
+        token = render_cancelled.set(cancel)
+        watcher = asyncio.create_task(self._watch_disconnect(request, cancel))
+        try:
+            return await self.run(func, *args, cost=cost, priority=priority, client=client, scheduled=scheduled, **kwargs)
+        finally:
+            watcher.cancel()
+            render_cancelled.reset(token)
+
+    async def _watch_disconnect(self, request, cancel):
+        # request.is_disconnected() only peeks and misses the disconnect behind the http middleware
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        logger.info("The client disconnected, cancelling its render")
+        cancel.set()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_render_executor():
+    """
+    Returns the process wide render executor, creating it on first use
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = RenderExecutor(max_workers=settings.RENDER_WORKERS,
+                                           max_queue=settings.RENDER_QUEUE_SIZE)
+    return _executor
+
+
+registry.register(Gauge("asi_render_in_flight", "Renders running or waiting on the render executor",
+                        function=lambda: _executor.pending if _executor is not None else 0))
+
+
+def shutdown_render_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
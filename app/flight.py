@@ -0,0 +1,152 @@
+"""
+path: app/flight.py
+
+This file contains the single-flight layer that coalesces concurrent identical
+renders. Calls with the same key in one process wait for the call in flight and
+share its result; calls in other processes on the same host wait on a lock file
+and then find the result in the shared disk cache.
+"""
+import os
+import time
+import logging
+import threading
+
+from app.config import settings
+from app.converter import ConversionCancelled
+from app.metrics import registry, Counter
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on windows, calls are only coalesced within the process
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+RENDERS_COALESCED = registry.register(Counter("asi_renders_coalesced_total",
+                                              "Renders served by an identical render already in flight"))
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time and hands its result to the concurrent callers of the same key.
+
+    The result is shared as is, so calls should return immutable values such as bytes.
+    A caller that waits longer than timeout stops waiting and runs the call itself.
+    """
+    def __init__(self, lock_dir=None, timeout=120, poll_interval=0.05):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key, func, lookup=None):
+        """
+        Returns func(), or the result of the identical call in flight.
+
+        lookup() is called once the lock of another process is released and
+        returns the result that process stored, or None to run func().
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                logger.warning("Render %s still in flight after %ss, rendering it again", key[:12], self.timeout)
+                return func()
+            if isinstance(flight.error, ConversionCancelled):
+                # the client of the call in flight went away, the first waiter to get here runs it again
+                return self.do(key, func, lookup)
+            if flight.error is not None:
+                raise flight.error
+            RENDERS_COALESCED.inc(scope="process")
+            return flight.result
+        try:
+            flight.result = self._locked(key, func, lookup)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _locked(self, key, func, lookup):
+        if not self.lock_dir:
+            return func()
+        path = os.path.join(self.lock_dir, key + ".lock")
+        descriptor, waited = self._acquire(path)
+        if descriptor is None:
+            logger.warning("Render %s still locked by another process after %ss, rendering it again", key[:12], self.timeout)
+            return func()
+        try:
+            if waited and lookup is not None:
+                result = lookup()
+                if result is not None:
+                    RENDERS_COALESCED.inc(scope="host")
+                    return result
+            return func()
+        finally:
+            # unlinked before the unlock, a process waiting on this file then sees it was replaced
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+
+    def _acquire(self, path):
+        """
+        Locks the lock file at path, returns its descriptor and whether another process held it, or None on timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            descriptor = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+            while True:
+                try:
+                    fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if time.monotonic() >= deadline:
+                        os.close(descriptor)
+                        return None, waited
+                    time.sleep(self.poll_interval)
+            try:
+                if os.fstat(descriptor).st_ino == os.stat(path).st_ino:
+                    return descriptor, waited
+            except FileNotFoundError:
+                pass
+            # the previous holder unlinked the file while we waited, lock the one at path now
+            os.close(descriptor)
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    Returns the process wide single-flight layer, creating it on first use
+    """
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(lock_dir=settings.LOCK_DIR or None, timeout=settings.SINGLE_FLIGHT_TIMEOUT)
+    return _single_flight
@@ -0,0 +1,251 @@
+"""
+path: app/jobs.py
+
+This file contains the SQLite backed job queue and the worker processes that
+render CVs in the background for the async mode of the routes.
+"""
+import os
+import json
+import time
+import contextlib
+import uuid
+import sqlite3
+import logging
+import threading
+import multiprocessing
+
+from app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# columns added after the first release, created on databases that predate them
+RENDER_COLUMNS = ["pdf_engine", "pdf_profile", "priority"]
+
+
+class JobQueue:
+    """
+    A persistent queue of render jobs stored in a local SQLite database.
+
+    Every call opens its own connection so the queue can be shared by the
+    server threads and the worker processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    file_format TEXT NOT NULL,
+                    output_type TEXT NOT NULL,
+                    pdf_engine TEXT,
+                    pdf_profile TEXT,
+                    priority TEXT,
+                    result BLOB,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+            for column in RENDER_COLUMNS:
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, profile, file_format="pdf", output_type="url", pdf_engine=None, pdf_profile=None, priority=None):
+        """
+        Stores a render of the Profile/RawProfile and returns the job id
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, status, kind, payload, file_format, output_type, pdf_engine, pdf_profile, priority, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, type(profile).__name__, profile.model_dump_json(), file_format, output_type,
+                 pdf_engine, pdf_profile, priority, now, now))
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self):
+        """
+        Marks the oldest queued job as running and returns it, or None when the queue is empty
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                                       (RUNNING, time.time(), row["id"]))
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return dict(row) if row is not None else None
+
+    def finish(self, job_id, result):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ?",
+                               (DONE, result, time.time(), job_id))
+
+    def fail(self, job_id, error):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                               (FAILED, error, time.time(), job_id))
+
+    def requeue_running(self):
+        """
+        Puts back jobs left running by workers that died, called before workers start
+        """
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?",
+                               (QUEUED, time.time(), RUNNING))
+
+    def purge(self, older_than):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                               (DONE, FAILED, time.time() - older_than))
+
+
+def _work(path, index, stop_event):
+    """
+    Entry point of a job worker process
+    """
+    from app.converter import shutdown_converter_pool
+    from app.metrics import registry
+    from app.render import render_profile
+    from app.scheduler import INTERACTIVE, render_priority
+    from app.schema import Profile, RawProfile
+
+    # every process owns its own LibreOffice workers, keep their ports apart from the server's
+    settings.CONVERTER_BASE_PORT = settings.CONVERTER_BASE_PORT + (index + 1) * settings.CONVERTER_POOL_SIZE
+    if settings.METRICS_DIR:
+        registry.start_directory(settings.METRICS_DIR, settings.METRICS_INTERVAL)
+    schemas = {"Profile": Profile, "RawProfile": RawProfile}
+    job_queue = JobQueue(path)
+    # a server process killed with SIGKILL never sets stop_event, its workers stop once it is gone
+    parent = multiprocessing.parent_process()
+    logger.info("Job worker %s started", index)
+    while not stop_event.is_set():
+        if parent is not None and not parent.is_alive():
+            logger.warning("The server process of job worker %s is gone, stopping", index)
+            break
+        job = job_queue.claim()
+        if job is None:
+            job_queue.purge(settings.JOB_RETENTION)
+            stop_event.wait(settings.JOB_POLL_INTERVAL)
+            continue
+        try:
+            profile = schemas[job["kind"]].model_validate_json(job["payload"])
+            # the conversions of the job wait for a LibreOffice worker in its class
+            render_priority.set(job["priority"] or INTERACTIVE)
+            output = render_profile(profile, file_format=job["file_format"], output_type=job["output_type"],
+                                    bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER,
+                                    credentials=settings.CREDENTIALS, pdf_engine=job["pdf_engine"],
+                                    pdf_profile=job["pdf_profile"])
+            if isinstance(output, str):
+                job_queue.finish(job["id"], output.encode("utf-8"))
+            elif isinstance(output, dict):
+                # the urls per format of several formats
+                job_queue.finish(job["id"], json.dumps(output).encode("utf-8"))
+            elif isinstance(output, bytes):
+                # the zip archive of several formats
+                job_queue.finish(job["id"], output)
+            else:
+                with output:
+                    job_queue.finish(job["id"], output.read())
+        except Exception as e:
+            logger.error("Job %s failed: %s", job["id"], e)
+            job_queue.fail(job["id"], str(e))
+    shutdown_converter_pool()
+    # multiprocessing ends the process without running the atexit handlers
+    registry.write()
+
+
+class JobWorkers:
+    """
+    Starts and stops the worker processes that drain the job queue
+    """
+    def __init__(self, path, count=1):
+        self.path = path
+        self.count = count
+        # spawn rather than fork, the server process already runs threads
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+        self._processes = []
+
+    def start(self):
+        JobQueue(self.path).requeue_running()
+        for index in range(self.count):
+            process = self._context.Process(target=_work, args=(self.path, index, self._stop_event),
+                                            name=f"asi-job-worker-{index}", daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def stop(self, timeout=10):
+        self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        self._processes = []
+
+
+_queue = None
+_workers = None
+_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Returns the process wide job queue, creating it on first use
+    """
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                _queue = JobQueue(settings.JOB_DB)
+    return _queue
+
+
+def start_job_workers():
+    global _workers
+    with _lock:
+        if _workers is None and settings.JOB_WORKERS > 0:
+            _workers = JobWorkers(settings.JOB_DB, count=settings.JOB_WORKERS)
+            _workers.start()
+
+
+def stop_job_workers():
+    global _workers
+    with _lock:
+        if _workers is not None:
+            _workers.stop()
+            _workers = None
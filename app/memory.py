@@ -0,0 +1,162 @@
+"""
+path: app/memory.py
+
+This file contains the memory budget that admits renders by their estimated cost
+and the tracemalloc sampler that reports the peak allocation of every render.
+"""
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from app.config import settings
+from app.metrics import registry, Gauge, Histogram
+from app.utils import ConversionCancelled
+
+
+logger = logging.getLogger(__name__)
+
+RENDER_PEAK_MEMORY = registry.register(Histogram("asi_render_peak_memory_bytes", "Peak memory allocated while a render ran, when TRACE_MEMORY is on",
+                                                 buckets=tuple(2 ** power * 1024 for power in range(8, 19))))
+
+
+class MemoryBudgetExhausted(Exception):
+    """
+    Raised when a render waited longer than its timeout for room in the memory budget
+    """
+
+
+class MemoryBudget:
+    """
+    Admits renders while the sum of their estimated costs stays within limit bytes.
+
+    A render that costs more than the whole budget is admitted once nothing
+    else holds a reservation, so it runs alone instead of never.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    @property
+    def reserved(self):
+        return self._reserved
+
+    @contextmanager
+    def reserve(self, cost, timeout=None, cancel=None):
+        """
+        Holds cost bytes of the budget for the duration of the block, waiting up to timeout seconds for them
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while self._reserved and self._reserved + cost > self.limit:
+                if cancel is not None and cancel.is_set():
+                    raise ConversionCancelled("The render was cancelled while waiting for memory")
+                remaining = deadline - time.monotonic() if deadline is not None else 0.25
+                if remaining <= 0:
+                    raise MemoryBudgetExhausted(f"{self._reserved // 2 ** 20}MiB of the {self.limit // 2 ** 20}MiB render memory budget "
+                                                "is in use, try again later")
+                # woken by every release, the timeout only rechecks the cancel event and the deadline
+                self._condition.wait(min(remaining, 0.25))
+            self._reserved += cost
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= cost
+                self._condition.notify_all()
+
+
+class MemoryTracer:
+    """
+    Samples tracemalloc every interval seconds and keeps the peak of every render being tracked.
+
+    tracemalloc counts the allocations of the whole process, so the peak of a
+    render running next to others includes what they allocated at the same time.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._renders = []
+        self._lock = threading.Lock()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        threading.Thread(target=self._sample, name="asi-memory-sampler", daemon=True).start()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            self._update()
+
+    def _update(self):
+        with self._lock:
+            # the peak since the last sample, so allocations between two samples are not missed
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            for render in self._renders:
+                render["peak"] = max(render["peak"], peak - render["start"])
+
+    @contextmanager
+    def track(self):
+        """
+        Yields a dict whose 'peak' is the bytes allocated above the start of the block at its highest
+        """
+        with self._lock:
+            render = {"start": tracemalloc.get_traced_memory()[0], "peak": 0}
+            self._renders.append(render)
+        try:
+            yield render
+        finally:
+            self._update()
+            with self._lock:
+                self._renders.remove(render)
+
+
+_budget = None
+_tracer = None
+_memory_lock = threading.Lock()
+
+
+def get_memory_budget():
+    """
+    Returns the process wide memory budget, None when RENDER_MEMORY_BUDGET is 0
+    """
+    global _budget
+    if _budget is None and settings.RENDER_MEMORY_BUDGET:
+        with _memory_lock:
+            if _budget is None:
+                _budget = MemoryBudget(settings.RENDER_MEMORY_BUDGET)
+    return _budget
+
+
+def get_memory_tracer():
+    """
+    Returns the process wide memory tracer, None unless TRACE_MEMORY is on
+    """
+    global _tracer
+    if _tracer is None and settings.TRACE_MEMORY:
+        with _memory_lock:
+            if _tracer is None:
+                _tracer = MemoryTracer(settings.TRACE_MEMORY_INTERVAL)
+    return _tracer
+
+
+@contextmanager
+def render_memory(cost, cancel=None):
+    """
+    Reserves the estimated cost of a render in the memory budget and, when tracing, reports its peak allocation
+    """
+    budget = get_memory_budget()
+    tracer = get_memory_tracer()
+    with budget.reserve(cost, timeout=settings.RENDER_MEMORY_WAIT, cancel=cancel) if budget is not None and cost else nullcontext():
+        if tracer is None:
+            yield
+            return
+        with tracer.track() as render:
+            yield
+        RENDER_PEAK_MEMORY.observe(render["peak"])
+        logger.info("Render peak memory %.1fMiB, estimated %.1fMiB", render["peak"] / 2 ** 20, cost / 2 ** 20)
+
+
+registry.register(Gauge("asi_render_memory_reserved_bytes", "Estimated memory held by the renders admitted by the memory budget",
+                        function=lambda: _budget.reserved if _budget is not None else 0))
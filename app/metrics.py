@@ -0,0 +1,235 @@
+"""
+path: app/metrics.py
+
+This file contains the per-stage timers of the render pipeline and a small
+registry of counters, gauges and histograms exposed in the Prometheus text format.
+Under app.serve every process writes its samples to a shared directory and
+/metrics adds up the samples of all of them.
+"""
+import os
+import json
+import time
+import bisect
+import atexit
+import logging
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+# stage timings of the request being served, shared with the render threads
+request_stages = contextvars.ContextVar("request_stages", default=None)
+request_id = contextvars.ContextVar("request_id", default="-")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.kind = "counter"
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+class Gauge(Counter):
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.kind = "gauge"
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return super().samples()
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.documentation = documentation
+        self.kind = "histogram"
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(dict(key), list(counts), total) for key, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), cumulative))
+            samples.append((self.name + "_count", labels, cumulative))
+            samples.append((self.name + "_sum", labels, total))
+        return samples
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """
+    Holds the metrics of the process. With a directory set, the samples of the
+    process are written there every interval seconds and render() adds up the
+    samples of every process that wrote to it. Counters and histograms of
+    processes that exited are kept, so totals never go backwards, gauges only
+    count the processes still running.
+    """
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def reset(self):
+        """
+        Drops the samples inherited from the parent process, called after a fork
+        """
+        for metric in self._metrics:
+            metric.reset()
+
+    def start_directory(self, directory, interval=5):
+        """
+        Writes the samples of this process to directory from now on
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        atexit.register(self.write)
+        threading.Thread(target=self._write_every, args=(interval,), name="asi-metrics-writer", daemon=True).start()
+
+    def _write_every(self, interval):
+        while True:
+            time.sleep(interval)
+            self.write()
+
+    def write(self):
+        """
+        Writes the samples of this process to its file in the directory
+        """
+        if self.directory is None:
+            return
+        snapshot = {"pid": os.getpid(), "metrics": {metric.name: metric.samples() for metric in self._metrics}}
+        try:
+            descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+            with os.fdopen(descriptor, "w") as file:
+                json.dump(snapshot, file)
+            os.replace(temporary, os.path.join(self.directory, f"{os.getpid()}.json"))
+        except OSError as e:
+            logger.warning("Could not write the metrics of process %s: %s", os.getpid(), e)
+
+    def _snapshots(self):
+        self.write()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                # removed or replaced while it was read
+                continue
+        return snapshots
+
+    def _samples(self, metric, snapshots):
+        if snapshots is None:
+            return metric.samples()
+        totals = {}
+        for snapshot in snapshots:
+            if metric.kind == "gauge" and not process_alive(snapshot["pid"]):
+                continue
+            for name, labels, value in snapshot["metrics"].get(metric.name, []):
+                key = (name, tuple(sorted(labels.items())))
+                totals[key] = totals.get(key, 0) + value
+        return [(name, dict(labels), value) for (name, labels), value in totals.items()]
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+        snapshots = self._snapshots() if self.directory is not None else None
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in self._samples(metric, snapshots):
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram("asi_render_stage_seconds", "Time spent in each render stage"))
+REQUEST_SECONDS = registry.register(Histogram("asi_http_request_seconds", "Time spent serving HTTP requests"))
+CONVERSION_QUEUE_DEPTH = registry.register(Gauge("asi_conversion_queue_depth", "Conversions waiting for a LibreOffice worker"))
+CONVERSION_FAILURES = registry.register(Counter("asi_conversion_failures_total", "Failed docx to pdf conversions"))
+CACHE_REQUESTS = registry.register(Counter("asi_cache_requests_total", "Render and fragment cache lookups by result"))
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a render stage into the stage histogram and the timings of the current request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = request_stages.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + elapsed
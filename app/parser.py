@@ -0,0 +1,127 @@
+"""
+path: app/parser.py
+
+This file contains the parsers that turn request profiles into ParsedProfile, the
+one shape ASI_CV is built from. RawProfile exports are parsed in a single pass
+over each delimited field and malformed entries are reported as field level
+errors, in the format of FastAPI's validation errors, instead of raising.
+"""
+import re
+
+from app.schema import ParsedExperience, ParsedLanguage, ParsedProfile
+
+
+# commas inside the parentheses of "English (excellent, native)" do not separate languages
+LANGUAGE_SEPARATOR = re.compile(r",(?![^(]*\))")
+LANGUAGE = re.compile(r"\s*(?P<language>[^()]*?)\s*\(\s*(?P<proficiency>[^()]*?)\s*\)?\s*")
+
+
+class ProfileParseError(ValueError):
+    """
+    Raised with the field level errors of a profile that can not be parsed
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(".".join(str(part) for part in error["loc"]) + ": " + error["msg"] for error in errors))
+
+
+def field_error(loc, msg):
+    return {"loc": list(loc), "msg": msg, "type": "value_error"}
+
+
+def split_entries(text, separator):
+    """
+    Splits a delimited field and drops the empty entries left by stray or trailing separators
+    """
+    return [entry for entry in map(str.strip, text.split(separator)) if entry]
+
+
+def split_languages(text):
+    """
+    Splits a well formed languages field on the closing parentheses, returns None when an entry is malformed
+    """
+    entries = text.split(")")
+    if entries.pop().strip(" ,"):
+        return None
+    pairs = [entry.split("(") for entry in entries]
+    if any(len(pair) != 2 for pair in pairs):
+        return None
+    # every entry after the first starts with the comma that separates it
+    if not all(entry.lstrip().startswith(",") for entry in entries[1:]):
+        return None
+    names = [language.strip(" ,") for language, _ in pairs]
+    if not all(names) or any("," in name for name in names):
+        return None
+    return [ParsedLanguage(name, proficiency.strip()) for name, (_, proficiency) in zip(names, pairs)]
+
+
+def parse_languages(text, errors):
+    if not text.strip():
+        return []
+    languages = split_languages(text)
+    if languages is not None:
+        return languages
+    # only a malformed field is matched entry by entry, to report which entries are wrong
+    languages = []
+    for index, entry in enumerate(LANGUAGE_SEPARATOR.split(text)):
+        if not entry.strip():
+            continue
+        match = LANGUAGE.fullmatch(entry)
+        if match is None or not match["language"]:
+            errors.append(field_error(("Languages", index), f'expected "Language (Proficiency)", got "{entry.strip()}"'))
+            continue
+        languages.append(ParsedLanguage(match["language"], match["proficiency"]))
+    return languages
+
+
+def parse_experiences(profile, errors):
+    years = list(map(str.strip, profile.ExperienceYears.split(",")))
+    headers = list(map(str.strip, profile.ExperienceHeader.split("|")))
+    contents = list(map(str.strip, profile.ExperienceContent.split("#")))
+    if not any(years) and not any(headers) and not any(contents):
+        return []
+    # a missing year or header is left empty, like the exports have always been read
+    count = max(len(years), len(headers))
+    if len(contents) < count:
+        errors.append(field_error(("ExperienceContent",), f"expected {count} entries separated by '#', got {len(contents)}"))
+        return []
+    years += [""] * (count - len(years))
+    headers += [""] * (count - len(headers))
+    return list(map(ParsedExperience, years, headers, contents))
+
+
+def parse_raw_profile(profile):
+    """
+    Returns the ParsedProfile of a RawProfile and the list of field level errors, empty when it parsed
+    """
+    errors = []
+    parsed = ParsedProfile.model_construct(
+        Name=profile.Name,
+        Title=profile.Title,
+        Qualifications=split_entries(profile.Qualifications.replace("•", ""), "|"),
+        TechnicalSkills=list(profile.TechnicalSkills),
+        Languages=parse_languages(profile.Languages, errors),
+        Countries=list(profile.Countries),
+        SummaryOfExperience=split_entries(profile.SummaryOfExperience, "||"),
+        Experiences=parse_experiences(profile, errors),
+    )
+    return parsed, errors
+
+
+def parse_profile(profile):
+    """
+    Returns the ParsedProfile of a structured Profile
+    """
+    return ParsedProfile.model_construct(
+        Name=profile.Name,
+        Title=profile.Title,
+        Qualifications=[f"{qualification.Degree} in {qualification.Field} from {qualification.Institution} in {qualification.Year}"
+                        for qualification in profile.Qualifications],
+        TechnicalSkills=list(profile.TechnicalSkills),
+        Languages=[ParsedLanguage(language.Language, language.Proficiency) for language in profile.Languages],
+        Countries=list(profile.Countries),
+        SummaryOfExperience=list(profile.SummaryOfExperience),
+        Experiences=[ParsedExperience(str(experience.DateRange), f"{experience.Position}, {experience.Organisation}, {experience.Location}",
+                                      experience.Summary, experience.IsSelected is True)
+                     for experience in profile.Experiences],
+    )
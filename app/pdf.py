@@ -0,0 +1,334 @@
+"""
+path: app/pdf.py
+
+This file contains the native pdf renderer. It lays out the fixed ASI CV template
+straight from the collected profile data, without building a docx or starting
+LibreOffice. fpdf2 is only used as the pdf canvas: lines are broken here with
+cached word widths, which is much faster than fpdf2's own multi_cell and tables.
+"""
+import os
+import logging
+
+from app.config import settings
+from app.metrics import stage
+
+try:
+    from fpdf import FPDF
+except ImportError:
+    FPDF = None
+
+
+logger = logging.getLogger(__name__)
+# fontTools logs every subset it writes at INFO
+logging.getLogger("fontTools").setLevel(logging.WARNING)
+
+PDF_ENGINES = ["libreoffice", "native"]
+
+# Liberation Sans has the metrics of Arial, the font of the docx template
+FONT_CANDIDATES = [
+    ("/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf"),
+    ("/usr/share/fonts/truetype/liberation2/LiberationSans-Regular.ttf", "/usr/share/fonts/truetype/liberation2/LiberationSans-Bold.ttf"),
+    ("/usr/share/fonts/truetype/msttcorefonts/Arial.ttf", "/usr/share/fonts/truetype/msttcorefonts/Arial_Bold.ttf"),
+    ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf"),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+]
+
+# the layout of ASI_CV in points: letter paper, half inch margins, 10pt Arial at 1.08 line spacing
+PAGE_MARGIN = 36
+FONT_SIZE = 10
+LINE_HEIGHT = 12.4
+ASCENT = 9.1
+CELL_MARGIN = 5.75
+BULLET_INDENT = 18
+BORDER_WIDTH = 0.5
+HEADER_WIDTHS = (108, 144, 108, 180)
+EMPLOYMENT_WIDTHS = (108, 432)
+SHADE = (0xD9, 0xE2, 0xF3)
+
+
+class NativePdfUnavailable(Exception):
+    """
+    Raised when the native pdf engine is selected but fpdf2 is not installed
+    """
+
+
+def find_fonts():
+    """
+    Returns the (regular, bold) TrueType files to embed for text outside latin-1, or None
+    """
+    if settings.PDF_FONT:
+        return settings.PDF_FONT, settings.PDF_FONT_BOLD or settings.PDF_FONT
+    for regular, bold in FONT_CANDIDATES:
+        if os.path.exists(regular) and os.path.exists(bold):
+            return regular, bold
+    return None
+
+
+def cv_texts(asi_cv):
+    yield asi_cv.name
+    yield asi_cv.title
+    for _, items, _ in asi_cv.header_rows():
+        yield from items
+    yield from asi_cv.summary_of_experience
+    for experience in asi_cv.experiences:
+        yield experience["Date Range"]
+        yield str(experience.get("Header"))
+        if experience.get("IsSelected") is True:
+            yield experience["Content"]
+
+
+def is_latin1(texts):
+    try:
+        for text in texts:
+            text.encode("latin-1")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def cell(text="", shade=None, bold=False, bullets=None, justify=True, center=True):
+    """
+    Returns a table cell, the defaults match ASI_CV.add_shaded_cell
+    """
+    return {"text": text, "shade": shade, "bold": bold, "bullets": bullets, "justify": justify, "center": center}
+
+
+class CVLayout:
+    """
+    Draws the sections of an ASI_CV in the order and style of ASI_CV.build_document.
+
+    The core Helvetica has the metrics of Arial and needs no embedding, so it is
+    used unless the profile has text outside latin-1 and a TrueType font is found.
+    """
+    def __init__(self, fonts=None):
+        if FPDF is None:
+            raise NativePdfUnavailable("The native pdf engine needs fpdf2, install it with 'pip install fpdf2'")
+        self.pdf = FPDF(unit="pt", format="letter")
+        self.pdf.set_margins(PAGE_MARGIN, PAGE_MARGIN, PAGE_MARGIN)
+        self.pdf.set_auto_page_break(False)
+        self.pdf.set_creator(settings.PROJECT_NAME)
+        if fonts is None:
+            self.family = "helvetica"
+            self.unicode = False
+        else:
+            self.family = "body"
+            self.unicode = True
+            self.pdf.add_font(self.family, "", fonts[0])
+            self.pdf.add_font(self.family, "B", fonts[1])
+        self.bold = None
+        self.widths = {}
+        self.left = PAGE_MARGIN
+        self.width = self.pdf.w - 2 * PAGE_MARGIN
+        self.bottom = self.pdf.h - PAGE_MARGIN
+        self.new_page()
+
+    def new_page(self):
+        self.pdf.add_page()
+        self.y = PAGE_MARGIN
+
+    def ensure(self, height):
+        """
+        Starts a new page unless height fits below the cursor
+        """
+        if self.y + height > self.bottom and self.y > PAGE_MARGIN:
+            self.new_page()
+
+    def set_bold(self, bold):
+        if bold != self.bold:
+            self.pdf.set_font(self.family, "B" if bold else "", FONT_SIZE)
+            self.bold = bold
+
+    def text(self, text):
+        """
+        Core fonts only cover latin-1, replace what they can not draw
+        """
+        text = str(text)
+        if self.unicode:
+            return text
+        text = text.replace("\u2013", "-").replace("\u2014", "-").replace("\u2018", "'").replace("\u2019", "'")
+        text = text.replace("\u201c", '"').replace("\u201d", '"')
+        return text.encode("latin-1", "replace").decode("latin-1")
+
+    def measure(self, word):
+        key = (self.bold, word)
+        width = self.widths.get(key)
+        if width is None:
+            width = self.widths[key] = self.pdf.get_string_width(word)
+        return width
+
+    def wrap(self, text, width):
+        """
+        Breaks text into lines no wider than width, returns a list of (words, words width, last line of paragraph)
+        """
+        space = self.measure(" ")
+        lines = []
+        for paragraph in self.text(text).split("\n"):
+            words, used = [], 0
+            for word in paragraph.split():
+                word_width = self.measure(word)
+                if words and used + space + word_width > width:
+                    lines.append((words, used - space * (len(words) - 1), False))
+                    words, used = [], 0
+                while word_width > width and len(word) > 1:
+                    # a single word wider than the line is split at the last character that fits
+                    cut = len(word) - 1
+                    while cut > 1 and self.measure(word[:cut]) > width:
+                        cut -= 1
+                    lines.append(([word[:cut]], self.measure(word[:cut]), False))
+                    word = word[cut:]
+                    word_width = self.measure(word)
+                used += (space if words else 0) + word_width
+                words.append(word)
+            lines.append((words, used - space * max(len(words) - 1, 0), True))
+        return lines
+
+    def draw_line(self, line, x, y, width, justify=False):
+        words, words_width, last = line
+        if not words:
+            return
+        baseline = y + ASCENT
+        if not justify or last or len(words) == 1:
+            self.pdf.text(x, baseline, " ".join(words))
+            return
+        gap = (width - words_width) / (len(words) - 1)
+        for word in words:
+            self.pdf.text(x, baseline, word)
+            x += self.measure(word) + gap
+
+    def paragraph(self, text, space_before=4, space_after=4, bold=False, justify=True):
+        self.set_bold(bold)
+        self.y += space_before
+        for line in self.wrap(text, self.width):
+            self.ensure(LINE_HEIGHT)
+            self.draw_line(line, self.left, self.y, self.width, justify=justify)
+            self.y += LINE_HEIGHT
+        self.y += space_after
+
+    def heading(self, text, line=True, space_before=6, space_after=4):
+        self.set_bold(True)
+        lines = self.wrap(text, self.width)
+        # keep the heading with the first line that follows it
+        self.ensure(space_before + LINE_HEIGHT * (len(lines) + 1))
+        self.y += space_before
+        for wrapped in lines:
+            self.draw_line(wrapped, self.left, self.y, self.width)
+            self.y += LINE_HEIGHT
+        if line:
+            self.pdf.set_line_width(BORDER_WIDTH)
+            self.pdf.line(self.left, self.y + 1, self.left + self.width, self.y + 1)
+            self.y += 1 + BORDER_WIDTH
+        self.y += space_after
+
+    def cell_lines(self, cell, width):
+        """
+        Returns the wrapped lines of a table cell with their indent, bulleted lines are marked "bullet"
+        """
+        self.set_bold(cell["bold"])
+        if not cell["bullets"]:
+            return [(line, 0) for line in self.wrap(cell["text"], width)]
+        lines = []
+        for item in cell["bullets"]:
+            for index, line in enumerate(self.wrap(item, width - BULLET_INDENT)):
+                lines.append((line, "bullet" if index == 0 else BULLET_INDENT))
+        return lines
+
+    def draw_row(self, laid_out, height, borders, center=True):
+        """
+        Draws one row of (cell, width, lines) at the cursor, center=False draws every cell from the top
+        """
+        x = self.left
+        for cell, width, lines in laid_out:
+            if cell["shade"] is not None:
+                self.pdf.set_fill_color(*cell["shade"])
+                self.pdf.rect(x, self.y, width, height, style="F")
+            self.set_bold(cell["bold"])
+            y = self.y + (height - LINE_HEIGHT * len(lines)) / 2 if center and cell["center"] else self.y
+            for line, indent in lines:
+                if indent == "bullet":
+                    self.pdf.set_fill_color(0, 0, 0)
+                    self.pdf.circle(x + CELL_MARGIN + 4.5, y + LINE_HEIGHT / 2, 1.6, style="F")
+                    indent = BULLET_INDENT
+                inner = width - 2 * CELL_MARGIN - indent
+                self.draw_line(line, x + CELL_MARGIN + indent, y, inner, justify=cell["justify"])
+                y += LINE_HEIGHT
+            if borders:
+                self.pdf.rect(x, self.y, width, height, style="D")
+            x += width
+        self.y += height
+
+    def table(self, rows, borders=True):
+        """
+        Draws rows of (cell, width) pairs, a merged cell is given the width of the columns it spans.
+
+        A row taller than a page is split across pages like a docx row that may break,
+        every page carries the lines of its cells that fit and the borders of the part drawn.
+        """
+        self.pdf.set_line_width(BORDER_WIDTH)
+        for row in rows:
+            laid_out = []
+            height = LINE_HEIGHT
+            for cell, width in row:
+                lines = self.cell_lines(cell, width - 2 * CELL_MARGIN)
+                laid_out.append((cell, width, lines))
+                height = max(height, LINE_HEIGHT * len(lines))
+            if height <= self.bottom - PAGE_MARGIN:
+                self.ensure(height)
+                self.draw_row(laid_out, height, borders)
+                continue
+            self.ensure(LINE_HEIGHT)
+            while True:
+                fits = max(int((self.bottom - self.y) // LINE_HEIGHT), 1)
+                part = [(cell, width, lines[:fits]) for cell, width, lines in laid_out]
+                laid_out = [(cell, width, lines[fits:]) for cell, width, lines in laid_out]
+                self.draw_row(part, LINE_HEIGHT * max(len(lines) for _, _, lines in part), borders, center=False)
+                if not any(lines for _, _, lines in laid_out):
+                    break
+                self.new_page()
+
+    def header_table(self, asi_cv):
+        name, position, label, value = HEADER_WIDTHS
+        rows = [[(cell("Name", shade=SHADE), name), (cell(asi_cv.name), position),
+                 (cell("Position", shade=SHADE), label), (cell(asi_cv.title), value)]]
+        for heading, items, bullet in asi_cv.header_rows():
+            # the value spans the last three columns, like the merged docx cells
+            if bullet:
+                merged = cell(bullets=items, justify=False, center=False)
+            else:
+                merged = cell(", ".join(items), justify=False, center=False)
+            rows.append([(cell(heading, shade=SHADE), name), (merged, position + label + value)])
+        self.table(rows)
+
+    def employment_table(self, experiences):
+        date_range, header = EMPLOYMENT_WIDTHS
+        self.table([[(cell(experience["Date Range"]), date_range), (cell(f"{experience.get('Header')}"), header)]
+                    for experience in experiences], borders=False)
+
+    def draw(self, asi_cv):
+        self.header_table(asi_cv)
+        self.heading("Summary of Experience")
+        for summary in asi_cv.summary_of_experience:
+            self.paragraph(summary)
+        self.heading("Employment History")
+        self.employment_table(asi_cv.experiences)
+        self.heading("Selected Experience")
+        for experience in asi_cv.selected_experiences():
+            self.heading(experience["Header"] + " (" + experience["Date Range"] + ")", line=False, space_before=4, space_after=0)
+            self.paragraph(experience["Content"], space_before=0, space_after=4)
+
+    def output(self):
+        return bytes(self.pdf.output())
+
+
+def render_pdf(asi_cv):
+    """
+    Returns the pdf bytes of the CV laid out like the docx template
+    """
+    with stage("convert_native"):
+        fonts = None
+        if not is_latin1(cv_texts(asi_cv)):
+            fonts = find_fonts()
+            if fonts is None:
+                logger.warning("No TrueType font found for the native pdf engine, characters outside latin-1 are replaced")
+        layout = CVLayout(fonts)
+        layout.draw(asi_cv)
+        return layout.output()
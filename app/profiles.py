@@ -0,0 +1,75 @@
+"""
+path: app/profiles.py
+
+This file contains the functions that turn request profiles into ASI_CV objects.
+"""
+from app.asi import ASI_CV
+from app.parser import parse_profile, parse_raw_profile, ProfileParseError
+from app.schema import RawProfile
+
+# the peak allocation of a docx render measured with tracemalloc: the skeleton copy
+# and the serialized package, plus the XML of every experience and character of text
+BASE_COST = 768 * 1024
+EXPERIENCE_COST = 4 * 1024
+CHARACTER_COST = 2
+
+
+def build_parsed_cv(parsed):
+    """
+    Creates an ASI_CV from a ParsedProfile
+    """
+    asi_cv = ASI_CV()
+    asi_cv._add_name_title(parsed.Name, parsed.Title)
+    for qualification in parsed.Qualifications:
+        asi_cv._add_raw_qualification(qualification)
+    for skill in parsed.TechnicalSkills:
+        asi_cv._add_technical_skill(skill)
+    for language in parsed.Languages:
+        asi_cv._add_language(language.Language, language.Proficiency)
+    for country in parsed.Countries:
+        asi_cv._add_country(country)
+    for summary in parsed.SummaryOfExperience:
+        asi_cv._add_summary_of_experience(summary)
+    for experience in parsed.Experiences:
+        asi_cv._add_raw_experience(experience.DateRange, experience.Header, experience.Content, experience.IsSelected)
+    return asi_cv
+
+
+def build_cv(profile):
+    """
+    Creates an ASI_CV from a structured Profile
+    """
+    return build_parsed_cv(parse_profile(profile))
+
+
+def build_raw_cv(profile):
+    """
+    Creates an ASI_CV from a RawProfile exported with the pipe/hash delimited fields,
+    raises ProfileParseError with the field level errors when it can not be parsed
+    """
+    parsed, errors = parse_raw_profile(profile)
+    if errors:
+        raise ProfileParseError(errors)
+    return build_parsed_cv(parsed)
+
+
+def build_profile_cv(profile):
+    """
+    Creates an ASI_CV from either a Profile or a RawProfile
+    """
+    if isinstance(profile, RawProfile):
+        return build_raw_cv(profile)
+    return build_cv(profile)
+
+
+def estimate_cost(profile):
+    """
+    Returns the estimated peak memory in bytes of rendering a Profile or RawProfile
+    """
+    if isinstance(profile, RawProfile):
+        experiences = profile.ExperienceContent.count("#") + 1
+        characters = len(profile.SummaryOfExperience) + len(profile.ExperienceHeader) + len(profile.ExperienceContent)
+    else:
+        experiences = len(profile.Experiences)
+        characters = sum(map(len, profile.SummaryOfExperience)) + sum(len(experience.Summary) for experience in profile.Experiences)
+    return BASE_COST + experiences * EXPERIENCE_COST + characters * CHARACTER_COST
@@ -0,0 +1,291 @@
+"""
+path: app/render.py
+
+This file contains the render entry point used by the routes, it sits in front of
+ASI_CV.generate_cv, serves repeat requests from the render cache and coalesces
+identical requests that arrive while the first one is still rendering.
+"""
+import io
+import json
+import uuid
+import hashlib
+import logging
+import zipfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from app.asi import TEMPLATE_VERSION
+from app.cache import canonical_hash, get_render_cache, get_object_cache
+from app.config import settings
+from app.converter import PDF_PROFILES
+from app.flight import get_single_flight
+from app.pdf import PDF_ENGINES
+from app.profiles import build_profile_cv
+from app.storage import object_name, upload_file, storage_url
+
+
+logger = logging.getLogger(__name__)
+
+FILE_FORMATS = ["docx", "pdf"]
+# the single-flight result of a render that is in the cache, each caller opens the entry itself
+CACHED = object()
+
+
+def render_key(profile, file_format, pdf_engine="libreoffice", pdf_profile="default"):
+    """
+    Returns the content hash of a validated Profile/RawProfile rendered as file_format
+    """
+    # the engines lay pdfs out differently, docx output does not depend on them
+    if file_format == "pdf" and pdf_engine == "libreoffice" and pdf_profile != "default":
+        # only LibreOffice takes export profiles, the default one keeps the keys renders were cached under
+        return canonical_hash(type(profile).__name__, profile.model_dump(mode="json"), file_format, pdf_engine, pdf_profile, TEMPLATE_VERSION)
+    if file_format == "pdf":
+        return canonical_hash(type(profile).__name__, profile.model_dump(mode="json"), file_format, pdf_engine, TEMPLATE_VERSION)
+    return canonical_hash(type(profile).__name__, profile.model_dump(mode="json"), file_format, TEMPLATE_VERSION)
+
+
+def url_key(key, bucket_name, folder):
+    """
+    Returns the object cache key of the object a render was uploaded to, the cache keeps its name and not its url
+    """
+    # signed urls expire, the url is made from the object name on every request
+    return canonical_hash("object", key, settings.STORAGE_BACKEND, bucket_name, folder)
+
+
+def cv_url(key, file_format):
+    """
+    Returns the stable url the app serves a cached render at, the same for every identical request
+    """
+    return f"{settings.PUBLIC_URL or f'http://localhost:{settings.PORT}'}/cv/{key}.{file_format}"
+
+
+def link_key(key):
+    """
+    Returns the object cache key of the link record of a render, its format and the sha256 of its bytes
+    """
+    return canonical_hash("link", key)
+
+
+def record_link(key, file_format, output):
+    """
+    Keeps the format and sha256 of the render cached under key with it, output is its bytes or an open binary file.
+
+    The stable url only serves the render as that format, with the sha256 as its strong ETag.
+    """
+    if isinstance(output, bytes):
+        digest = hashlib.sha256(output).hexdigest()
+    else:
+        digest = hashlib.file_digest(output, "sha256").hexdigest()
+        output.seek(0)
+    cache = get_object_cache()
+    # a render evicted and rendered again may differ byte for byte, its record is replaced
+    cache.delete(link_key(key))
+    cache.set(link_key(key), json.dumps({"format": file_format, "sha256": digest}).encode("utf-8"))
+
+
+def link_record(key):
+    """
+    Returns the link record of the render cached under key, or None when it has none
+    """
+    value = get_object_cache().get(link_key(key))
+    return json.loads(value) if value is not None else None
+
+
+def blob_name(profile, file_format, folder):
+    return object_name(folder, profile.Name, uuid.uuid4(), file_format)
+
+
+def upload_render(file, profile, file_format, bucket_name, folder, credentials):
+    """
+    Uploads a rendered file under a new object name and returns the name
+    """
+    name = blob_name(profile, file_format, folder)
+    upload_file(file, name, "application/" + file_format, bucket_name, credentials, filename=f"{profile.Name} ASI CV Export.{file_format}")
+    return name
+
+
+def parse_file_formats(file_format):
+    """
+    Returns the formats of a comma separated file_format such as 'docx,pdf', in order and without repeats
+    """
+    file_formats = list(dict.fromkeys(name.strip() for name in file_format.split(",")))
+    if any(name not in FILE_FORMATS for name in file_formats):
+        raise ValueError("The file format should be 'docx', 'pdf' or both as 'docx,pdf'")
+    return file_formats
+
+
+def resolve_pdf_engine(pdf_engine=None):
+    """
+    Returns the requested pdf engine, or PDF_ENGINE when none is requested
+    """
+    pdf_engine = pdf_engine or settings.PDF_ENGINE
+    if pdf_engine not in PDF_ENGINES:
+        raise ValueError("The pdf engine should be either 'libreoffice' or 'native'")
+    return pdf_engine
+
+
+def resolve_pdf_profile(pdf_profile=None):
+    """
+    Returns the requested pdf export profile, or PDF_PROFILE when none is requested
+    """
+    pdf_profile = pdf_profile or settings.PDF_PROFILE
+    if pdf_profile not in PDF_PROFILES:
+        raise ValueError(f"The pdf profile should be one of {', '.join(PDF_PROFILES)}")
+    return pdf_profile
+
+
+def render_file(profile, file_format, pdf_engine, key, pdf_profile="default"):
+    """
+    Returns the rendered profile as an open binary file, from the cache or a single render per key.
+
+    The render is streamed into the cache and every caller opens the entry on its own,
+    so a render larger than the memory tier is never read into memory. Only a render
+    the cache can not keep is shared between the callers as bytes.
+    """
+    cache = get_render_cache()
+    output = cache.get_file(key)
+    if output is not None:
+        return output
+
+    def render():
+        with build_profile_cv(profile).render_stream(file_format, pdf_engine=pdf_engine, pdf_profile=pdf_profile) as output:
+            if cache.set_file(key, output):
+                record_link(key, file_format, output)
+                return CACHED
+            return output.read()
+
+    result = get_single_flight().do(key, render, lookup=lambda: CACHED if cache.contains(key) else None)
+    if result is not CACHED:
+        return io.BytesIO(result)
+    output = cache.get_file(key)
+    if output is None:
+        # evicted before it was opened, the caller renders a copy of its own
+        return build_profile_cv(profile).render_stream(file_format, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
+    return output
+
+
+def render_files(profile, file_formats, pdf_engine, keys, pdf_profile="default"):
+    """
+    Returns a dict of the rendered bytes per format, rendering the formats missing from the cache in a single pass
+    """
+    cache = get_render_cache()
+    files = {}
+    for file_format in file_formats:
+        data = cache.get(keys[file_format])
+        if data is not None:
+            files[file_format] = data
+    missing = [file_format for file_format in file_formats if file_format not in files]
+    if not missing:
+        return files
+
+    def render():
+        rendered = build_profile_cv(profile).render_formats(missing, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
+        for file_format, data in rendered.items():
+            cache.set(keys[file_format], data)
+            record_link(keys[file_format], file_format, data)
+        return rendered
+
+    def lookup():
+        rendered = {file_format: cache.get(keys[file_format]) for file_format in missing}
+        return rendered if all(data is not None for data in rendered.values()) else None
+
+    files.update(get_single_flight().do(canonical_hash(*[keys[file_format] for file_format in missing]), render, lookup=lookup))
+    return files
+
+
+def archive_files(profile, files):
+    """
+    Packs the rendered files of one profile into a zip, they are compressed already so they are stored as is
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for file_format, data in files.items():
+            archive.writestr(f"{profile.Name} ASI CV Export.{file_format}", data)
+    return buffer.getvalue()
+
+
+def render_formats(profile, file_formats, output_type, bucket_name, folder, credentials, pdf_engine, pdf_profile="default"):
+    """
+    Renders the profile in several formats from one build, returning a dict of urls per format or the bytes of a zip archive
+    """
+    keys = {file_format: render_key(profile, file_format, pdf_engine, pdf_profile) for file_format in file_formats}
+    if output_type == "file":
+        return archive_files(profile, render_files(profile, file_formats, pdf_engine, keys, pdf_profile))
+    if output_type == "link":
+        files = render_files(profile, file_formats, pdf_engine, keys, pdf_profile)
+        for file_format in file_formats:
+            if link_record(keys[file_format]) is None:
+                # cached without a record, its sha256 is taken once here
+                record_link(keys[file_format], file_format, files[file_format])
+        return {file_format: cv_url(keys[file_format], file_format) for file_format in file_formats}
+    cache = get_object_cache()
+    uploaded_keys = {file_format: url_key(keys[file_format], bucket_name, folder) for file_format in file_formats}
+    urls = {}
+    for file_format in file_formats:
+        name = cache.get(uploaded_keys[file_format])
+        if name is not None:
+            urls[file_format] = storage_url(name.decode("utf-8"), bucket_name, credentials)
+    missing = [file_format for file_format in file_formats if file_format not in urls]
+    if not missing:
+        return urls
+    files = render_files(profile, missing, pdf_engine, keys, pdf_profile)
+
+    def upload(file_format):
+        name = upload_render(files[file_format], profile, file_format, bucket_name, folder, credentials)
+        cache.set(uploaded_keys[file_format], name.encode("utf-8"))
+        return storage_url(name, bucket_name, credentials)
+
+    with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix="asi-upload") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, upload, file_format) for file_format in missing]
+    for file_format, future in zip(missing, futures):
+        urls[file_format] = future.result()
+    return {file_format: urls[file_format] for file_format in file_formats}
+
+
+def render_profile(profile, file_format="pdf", output_type="url", bucket_name=None, folder=None, credentials=None, pdf_engine=None, pdf_profile=None):
+    """
+    Renders the profile, returning the public url, an open binary file or, for
+    output_type='link', the stable url of the render served from the cache.
+
+    The rendered bytes are cached by content hash and uploaded objects by content
+    hash and destination, so a repeat request neither builds nor converts. A
+    request identical to one in flight, in this or another worker process,
+    waits for it and gets its result.
+
+    Several comma separated formats such as 'docx,pdf' are built once and
+    returned as a dict of urls or links per format, or as the bytes of a zip archive.
+    LibreOffice pdfs are exported with the options of the pdf_profile export profile.
+    """
+    file_formats = parse_file_formats(file_format)
+    if output_type not in ["url", "file", "link"]:
+        raise ValueError("The output type should be 'url', 'file' or 'link'")
+    if output_type == "url" and (bucket_name is None or folder is None or credentials is None):
+        raise ValueError("The bucket name, folder and credentials should be provided when the output type is 'url'")
+    pdf_engine = resolve_pdf_engine(pdf_engine)
+    pdf_profile = resolve_pdf_profile(pdf_profile)
+    if len(file_formats) > 1:
+        return render_formats(profile, file_formats, output_type, bucket_name, folder, credentials, pdf_engine, pdf_profile)
+    file_format = file_formats[0]
+    key = render_key(profile, file_format, pdf_engine, pdf_profile)
+    if output_type == "file":
+        return render_file(profile, file_format, pdf_engine, key, pdf_profile)
+    if output_type == "link":
+        with render_file(profile, file_format, pdf_engine, key, pdf_profile) as output:
+            if link_record(key) is None:
+                # cached without a record, its sha256 is taken once here
+                record_link(key, file_format, output)
+        return cv_url(key, file_format)
+    cache = get_object_cache()
+    uploaded_key = url_key(key, bucket_name, folder)
+    name = cache.get(uploaded_key)
+    if name is not None:
+        return storage_url(name.decode("utf-8"), bucket_name, credentials)
+
+    def upload():
+        with render_file(profile, file_format, pdf_engine, key, pdf_profile) as output:
+            name = upload_render(output, profile, file_format, bucket_name, folder, credentials).encode("utf-8")
+        cache.set(uploaded_key, name)
+        return name
+
+    name = get_single_flight().do(uploaded_key, upload, lookup=lambda: cache.get(uploaded_key))
+    return storage_url(name.decode("utf-8"), bucket_name, credentials)
@@ -7,49 +7,193 @@ This file contains the main router for the application.
 from fastapi import APIRouter, Request, BackgroundTasks, File, UploadFile, Depends, HTTPException, status, Form
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from starlette.requests import Request
 from starlette.responses import Response
-from app.asi import ASI_CV
-from app.schema import Profile, RawProfile
+from starlette.background import BackgroundTask
+from app.asi import scratch_dir
+from app.batch import generate_batch
+from app.bulk import get_bulk_executor, stream_import
+from app.cache import get_render_cache
+from app.converter import PDF_PROFILES, ConversionError, ConversionTimeout, ConversionCancelled
+from app.executor import get_render_executor, RenderQueueFull
+from app.jobs import get_job_queue, DONE, FAILED
+from app.metrics import registry
+from app.parser import ProfileParseError
+from app.profiles import estimate_cost
+from app.render import render_profile, parse_file_formats, resolve_pdf_engine, resolve_pdf_profile, link_record
+from app.scheduler import INTERACTIVE, BULK, resolve_priority
+from app.schema import Profile, RawProfile, BatchRequest
 from app.config import settings
+from app.delivery import digest_etag, artifact_response
 
 import os
+import re
+import json
+import time
+import asyncio
+import tempfile
 
 router = APIRouter()
 templates = Jinja2Templates(directory=settings.TEMPLATES_DIR)
 
+CONTENT_HASH = re.compile(r"^[0-9a-f]{64}$")
+MEDIA_TYPES = {
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pdf": "application/pdf",
+}
+
+
+def iter_file(file, chunk_size=64 * 1024):
+    """
+    Yields the content of a binary file in chunks and closes it
+    """
+    with file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def file_response(file, file_format):
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    return StreamingResponse(iter_file(file), media_type=MEDIA_TYPES[file_format], headers={"Content-Length": str(size)})
+
+
+def render_response(output, file_format, output_type):
+    """
+    Returns the response of a sync render, a url per format or a zip archive when several formats were rendered
+    """
+    if len(parse_file_formats(file_format)) > 1:
+        if output_type in ("url", "link"):
+            return {"urls": output}
+        return Response(content=output, media_type="application/zip", headers={"Content-Disposition": 'attachment; filename="ASI CV Export.zip"'})
+    if output_type in ("url", "link"):
+        return {"url": output}
+    return file_response(output, file_format)
+
+
+def request_priority(request, priority, default):
+    """
+    Returns the priority class and the client of a request, the client is its API key or else its address
+    """
+    api_key = request.headers.get("x-api-key")
+    try:
+        priority = resolve_priority(priority, api_key, default)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return priority, api_key or (request.client.host if request.client else None)
+
+
+def check_pdf_profile(pdf_profile):
+    """
+    Rejects an unknown pdf export profile with a 400 before any work is queued
+    """
+    if pdf_profile is not None and pdf_profile not in PDF_PROFILES:
+        raise HTTPException(status_code=400, detail=f"The pdf profile should be one of {', '.join(PDF_PROFILES)}")
+
+
+def check_output(file_format, output_type, output_types=("url", "file", "link"), several=True):
+    """
+    Rejects an unknown file format or output type with a 400 before any work is queued,
+    several=False for the routes that render a single format
+    """
+    if output_type not in output_types:
+        names = [f"'{name}'" for name in output_types]
+        raise HTTPException(status_code=400, detail=f"The output type should be {', '.join(names[:-1])} or {names[-1]}")
+    try:
+        file_formats = parse_file_formats(file_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(file_formats) > 1 and not several:
+        raise HTTPException(status_code=400, detail="The file format should be either 'docx' or 'pdf'")
+
+
+def check_pdf_engine(pdf_engine):
+    """
+    Rejects an unknown pdf engine with a 400 before any work is queued
+    """
+    try:
+        resolve_pdf_engine(pdf_engine)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def enqueue_job(profile, file_format, output_type, pdf_engine=None, pdf_profile=None, priority=None):
+    """
+    Queues a render for the job workers, with every option of the sync render resolved now
+    """
+    if output_type not in ["url", "file", "link"]:
+        raise HTTPException(status_code=400, detail="The output type should be 'url', 'file' or 'link'")
+    try:
+        file_format = ",".join(parse_file_formats(file_format))
+        pdf_engine = resolve_pdf_engine(pdf_engine)
+        pdf_profile = resolve_pdf_profile(pdf_profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job_id = get_job_queue().enqueue(profile, file_format, output_type, pdf_engine=pdf_engine, pdf_profile=pdf_profile, priority=priority)
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"id": job_id, "status": "queued"}, headers={"Location": f"/jobs/{job_id}"})
+
 
 
 @router.post("/")
-async def create_cv(profile: Profile, file_format: str = "pdf", output_type: str = "url"):
-    asi_cv = ASI_CV()
-    asi_cv._add_name_title(profile.Name, profile.Title)
-    for qualification in profile.Qualifications:
-        asi_cv._add_qualification(qualification.Degree, qualification.Field, qualification.Institution, str(qualification.Year))
-    for skill in profile.TechnicalSkills:
-        asi_cv._add_technical_skill(skill)
-    for language in profile.Languages:
-        asi_cv._add_language(language.Language, language.Proficiency)
-    for country in profile.Countries:
-        asi_cv._add_country(country)
-    for summary in profile.SummaryOfExperience:
-        asi_cv._add_summary_of_experience(summary)
-    for experience in profile.Experiences:
-        asi_cv._add_experience(str(experience.DateRange), experience.Position, experience.Organisation, experience.Location, experience.Summary, experience.IsSelected)
+async def create_cv(profile: Profile, request: Request, file_format: str = "pdf", output_type: str = "url", mode: str = "sync", pdf_engine: str = None, pdf_profile: str = None, priority: str = None):
+    priority, client = request_priority(request, priority, INTERACTIVE)
+    check_output(file_format, output_type)
+    check_pdf_engine(pdf_engine)
+    check_pdf_profile(pdf_profile)
+    if mode == "async":
+        return enqueue_job(profile, file_format, output_type, pdf_engine, pdf_profile, priority)
     try:
-        output = asi_cv.generate_cv(file_format=file_format, output_type=output_type, bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS)
-        if output_type == "url":
-            return {"url": output}
-        if output_type == "file":
-            if file_format == "docx":
-                print("docx")
-                return Response(content=output, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            if file_format == "pdf":
-                return Response(content=output, media_type="application/pdf")
+        output = await get_render_executor().run_for(request, render_profile, profile, cost=estimate_cost(profile), priority=priority, client=client, file_format=file_format, output_type=output_type, bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
+        return render_response(output, file_format, output_type)
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={"Retry-After": "1"})
+    except ConversionCancelled as e:
+        # nobody reads this, the client is gone
+        raise HTTPException(status_code=499, detail=str(e))
+    except ConversionTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+    except ConversionError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def serve_cv(content_hash, file_format, headers):
+    """
+    Returns the response to a GET of a render from the cache, or None when it is not cached as file_format
+    """
+    record = link_record(content_hash)
+    # the hash of a docx render must not serve it as a pdf
+    if record is None or record["format"] != file_format:
+        return None
+    file = get_render_cache().get_file(content_hash)
+    if file is None:
+        return None
+    return artifact_response(file, MEDIA_TYPES[file_format], headers, f"public, max-age={settings.CV_MAX_AGE}", digest_etag(record["sha256"]))
+
+
+@router.api_route("/cv/{content_hash}.{file_format}", methods=["GET", "HEAD"])
+async def get_cv(content_hash: str, file_format: str, request: Request):
+    """
+    Serves a render at the stable url returned for output_type=link, with ETags, 304s and range requests
+    """
+    if file_format not in MEDIA_TYPES or not CONTENT_HASH.match(content_hash):
+        raise HTTPException(status_code=404, detail="CV not found")
+    # a render in the disk tier is opened and sized off the event loop
+    response = await asyncio.to_thread(serve_cv, content_hash, file_format, request.headers)
+    if response is None:
+        # evicted from the cache, posting the profile again with output_type=link renders it anew,
+        # so the 404 must not be cached in place of the CV
+        raise HTTPException(status_code=404, detail="CV not found", headers={"Cache-Control": "no-store"})
+    return response
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @router.get("/" , response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -57,50 +201,116 @@ async def home(request: Request):
 
 
 @router.post("/raw_data")
-async def for_raw_data(profile: RawProfile, file_format: str = "pdf", output_type: str = "url"):
-    asi_cv = ASI_CV()
-    asi_cv._add_name_title(profile.Name, profile.Title)
-    qualifications = profile.Qualifications.replace("•", "").split("|")
-    for qualification in qualifications:
-        # degree, field, institution, year = qualification.split(",")
-        # asi_cv._add_qualification(degree, field, institution, year)
-        asi_cv._add_raw_qualification(qualification)
-    for skill in profile.TechnicalSkills:
-        asi_cv._add_technical_skill(skill)
-    # language are in this format English (excellent), French (basic)
-    # split by comma and then by space
-    languages = profile.Languages.split(",")
-    for language in languages:
-        language, proficiency = language.split(" (")
-        proficiency = proficiency.replace(")", "")
-        asi_cv._add_language(language, proficiency)
-    for country in profile.Countries:
-        asi_cv._add_country(country)
-    summary_of_experiences = profile.SummaryOfExperience.split("||")
-    for summary in summary_of_experiences:
-        asi_cv._add_summary_of_experience(summary)
-    experiences_years = profile.ExperienceYears.split(",")
-    experiences_headers = profile.ExperienceHeader.split("|")
-    experiences_content = profile.ExperienceContent.split("#")
-    # make length of experiences_years and experiences_headers the same
-    if len(experiences_years) > len(experiences_headers):
-        experiences_headers = experiences_headers + [""] * (len(experiences_years) - len(experiences_headers))
-    if len(experiences_headers) > len(experiences_years):
-        experiences_years = experiences_years + [""] * (len(experiences_headers) - len(experiences_years))
-    for i, experience_header in enumerate(experiences_headers):
-        if len(experiences_years) > i:
-            date_range = experiences_years[i]
-            asi_cv._add_raw_experience(date_range, experience_header, experiences_content[i])
-            # asi_cv._add_experience(date_range, position, organisation, location, experiences_content[i], True)
+async def for_raw_data(profile: RawProfile, request: Request, file_format: str = "pdf", output_type: str = "url", mode: str = "sync", pdf_engine: str = None, pdf_profile: str = None, priority: str = None):
+    priority, client = request_priority(request, priority, INTERACTIVE)
+    check_output(file_format, output_type)
+    check_pdf_engine(pdf_engine)
+    check_pdf_profile(pdf_profile)
+    if mode == "async":
+        return enqueue_job(profile, file_format, output_type, pdf_engine, pdf_profile, priority)
+    try:
+        output = await get_render_executor().run_for(request, render_profile, profile, cost=estimate_cost(profile), priority=priority, client=client, file_format=file_format, output_type=output_type, bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
+        return render_response(output, file_format, output_type)
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={"Retry-After": "1"})
+    except ProfileParseError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=[dict(error, loc=["body"] + error["loc"]) for error in e.errors])
+    except ConversionCancelled as e:
+        # nobody reads this, the client is gone
+        raise HTTPException(status_code=499, detail=str(e))
+    except ConversionTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+    except ConversionError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/batch")
+async def create_batch(batch: BatchRequest, request: Request, file_format: str = "pdf", output_type: str = "url", pdf_engine: str = None, pdf_profile: str = None, priority: str = None):
+    profiles = batch.Profiles + batch.RawProfiles
+    priority, client = request_priority(request, priority, BULK)
+    check_output(file_format, output_type, output_types=("url", "file"), several=False)
+    check_pdf_engine(pdf_engine)
+    check_pdf_profile(pdf_profile)
     try:
-        output = asi_cv.generate_cv(file_format=file_format, output_type=output_type, bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS)
+        output = await get_render_executor().run_for(request, generate_batch, profiles, priority=priority, client=client, scheduled=False, file_format=file_format, output_type=output_type, bucket_name=settings.BUCKET_NAME, folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS, pdf_engine=pdf_engine, pdf_profile=pdf_profile)
         if output_type == "url":
-            return {"url": output}
+            return {"results": output}
         if output_type == "file":
-            if file_format == "docx":
-                print("docx")
-                return Response(content=output, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            if file_format == "pdf":
-                return Response(content=output, media_type="application/pdf")
+            return Response(content=output, media_type="application/zip", headers={"Content-Disposition": 'attachment; filename="ASI CV Export.zip"'})
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={"Retry-After": "1"})
+    except ConversionCancelled as e:
+        raise HTTPException(status_code=499, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/bulk")
+async def bulk_import(request: Request, file_format: str = "pdf", pdf_engine: str = None, pdf_profile: str = None, priority: str = None):
+    """
+    Imports a newline delimited stream of RawProfile records and streams back one NDJSON result per record
+    """
+    if file_format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="The file format should be either 'docx' or 'pdf'")
+    priority, client = request_priority(request, priority, BULK)
+    check_pdf_engine(pdf_engine)
+    check_pdf_profile(pdf_profile)
+    try:
+        release = get_bulk_executor().admit()
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={"Retry-After": "1"})
+    # StreamingResponse reads the connection to watch for disconnects, so the body is spooled
+    # (to disk past SPOOL_MAX_SIZE) before the first result is sent
+    try:
+        upload = tempfile.SpooledTemporaryFile(max_size=settings.SPOOL_MAX_SIZE, dir=scratch_dir())
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+    except BaseException:
+        release()
+        raise
+    # the stream ends the import when it finishes, the background task when the stream never started
+    return StreamingResponse(stream_import(upload, release=release, file_format=file_format, bucket_name=settings.BUCKET_NAME,
+                                           folder=settings.BUCKET_FOLDER, credentials=settings.CREDENTIALS, pdf_engine=pdf_engine,
+                                           pdf_profile=pdf_profile, priority=priority, client=client),
+                             media_type="application/x-ndjson", background=BackgroundTask(release))
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """
+    Returns the status of an async job, waiting up to `wait` seconds (max 60) for it to finish
+    """
+    job_queue = get_job_queue()
+    deadline = time.monotonic() + min(max(wait, 0), 60)
+    job = job_queue.get(job_id)
+    while job is not None and job["status"] not in (DONE, FAILED) and time.monotonic() < deadline:
+        await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+        job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    content = {"id": job["id"], "status": job["status"]}
+    if job["status"] == FAILED:
+        content["error"] = job["error"]
+    if job["status"] == DONE:
+        if job["output_type"] in ("url", "link") and "," in job["file_format"]:
+            content["urls"] = json.loads(job["result"])
+        elif job["output_type"] in ("url", "link"):
+            content["url"] = job["result"].decode("utf-8")
+        else:
+            content["result"] = f"/jobs/{job_id}/result"
+    return content
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != DONE or job["output_type"] != "file":
+        raise HTTPException(status_code=409, detail=f"The job is {job['status']} and has no file result")
+    if "," in job["file_format"]:
+        return Response(content=job["result"], media_type="application/zip", headers={"Content-Disposition": 'attachment; filename="ASI CV Export.zip"'})
+    return Response(content=job["result"], media_type=MEDIA_TYPES[job["file_format"]])
@@ -0,0 +1,122 @@
+"""
+path: app/rows.py
+
+This file contains the bulk writer that emits the tables and paragraphs of the CV as
+pre-styled WordprocessingML. It writes the same XML the python-docx cell by cell
+builders write, as one string per section parsed once, instead of adding rows through
+python-docx, which walks the grid of the whole table on every row it adds.
+"""
+import re
+from xml.sax.saxutils import escape
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+
+
+# python-docx turns tabs into <w:tab/> and line breaks into <w:br/>
+RUN_BREAKS = re.compile(r"([\t\r\n])")
+ELEMENT_TAG = re.compile(r"^(<w:\w+)")
+
+HEADER_WIDTHS = (2160, 2880, 2160, 3600)
+EMPLOYMENT_WIDTHS = (2160, 8640)
+
+SHADED_CELL = ('<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/><w:vAlign w:val="center"/><w:shd w:fill="{shade}"/></w:tcPr>'
+               '<w:p><w:pPr><w:spacing w:before="0" w:after="0"/><w:jc w:val="both"/></w:pPr>'
+               '<w:r><w:rPr><w:rFonts w:ascii="Arial" w:hAnsi="Arial"/><w:b{bold}/><w:sz w:val="20"/></w:rPr>{text}</w:r></w:p></w:tc>')
+MERGED_CELL = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/><w:gridSpan w:val="{span}"/></w:tcPr>{paragraphs}</w:tc>'
+BULLET = '<w:p><w:pPr><w:pStyle w:val="ListBullet"/><w:spacing w:before="0" w:after="0"/></w:pPr><w:r>{text}</w:r></w:p>'
+EMPLOYMENT_TABLE = ('<w:tbl><w:tblPr><w:tblW w:type="auto" w:w="0"/><w:tblLayout w:type="autofit"/>'
+                    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+                    '</w:tblPr><w:tblGrid>{grid}</w:tblGrid>{rows}</w:tbl>')
+HEADING = ('<w:p><w:pPr><w:pStyle w:val="Heading1"/><w:spacing w:before="{before}" w:after="{after}" w:line="264" w:lineRule="auto"/>'
+           '<w:ind w:left="0"/><w:jc w:val="left"/>{border}</w:pPr>{run}</w:p>')
+HEADING_RUN = '<w:r><w:rPr><w:rFonts w:ascii="Arial" w:hAnsi="Arial"/><w:b/><w:color w:val="000000"/><w:sz w:val="20"/></w:rPr>{text}</w:r>'
+HEADING_BORDER = '<w:pBdr><w:bottom w:val="single" w:sz="4" w:space="1" w:color="000000"/></w:pBdr>'
+PARAGRAPH = '<w:p><w:pPr><w:spacing w:before="{before}" w:after="{after}"/><w:jc w:val="{alignment}"/></w:pPr>{run}</w:p>'
+
+
+def twips(points):
+    return int(points * 20)
+
+
+def run_text(text):
+    """
+    Returns the content of a <w:r> holding text, as python-docx writes it
+    """
+    content = []
+    for part in RUN_BREAKS.split(text):
+        if part == "\t":
+            content.append("<w:tab/>")
+        elif part in ("\r", "\n"):
+            content.append("<w:br/>")
+        elif part:
+            preserve = ' xml:space="preserve"' if len(part.strip()) < len(part) else ""
+            content.append(f"<w:t{preserve}>{escape(part)}</w:t>")
+    return "".join(content)
+
+
+def shaded_cell(text, width, shade, bold=False):
+    return SHADED_CELL.format(width=width, shade=shade, bold="" if bold else ' w:val="0"', text=run_text(text))
+
+
+def bullet_paragraphs(items):
+    """
+    Returns the paragraphs of a bulleted cell, an empty item is overwritten by the next like in add_bullet_point
+    """
+    bullets = [None]
+    for item in items:
+        if not bullets[0]:
+            bullets[0] = item
+        else:
+            bullets.append(item)
+    return "".join("<w:p/>" if item is None else BULLET.format(text=run_text(item)) for item in bullets)
+
+
+def header_rows(name, title, rows, shade):
+    """
+    Returns the <w:tr> rows of the header table: name and position, then a merged row per (heading, items, bullet)
+    """
+    xml = ["<w:tr>" + shaded_cell("Name", HEADER_WIDTHS[0], shade) + shaded_cell(name, HEADER_WIDTHS[1], "FFFFFF")
+           + shaded_cell("Position", HEADER_WIDTHS[2], shade) + shaded_cell(title, HEADER_WIDTHS[3], "FFFFFF") + "</w:tr>"]
+    merged_width = sum(HEADER_WIDTHS[1:])
+    for heading, items, bullet in rows:
+        if bullet:
+            paragraphs = bullet_paragraphs(items)
+        else:
+            paragraphs = f"<w:p><w:r>{run_text(', '.join(items))}</w:r></w:p>"
+        xml.append("<w:tr>" + shaded_cell(heading, HEADER_WIDTHS[0], shade)
+                   + MERGED_CELL.format(width=merged_width, span=len(HEADER_WIDTHS) - 1, paragraphs=paragraphs) + "</w:tr>")
+    return xml
+
+
+def employment_table(experiences):
+    """
+    Returns the <w:tbl> of the employment history, a row with the date range and header per experience
+    """
+    grid = "".join(f'<w:gridCol w:w="{width}"/>' for width in EMPLOYMENT_WIDTHS)
+    rows = "".join("<w:tr>" + shaded_cell(experience["Date Range"], EMPLOYMENT_WIDTHS[0], "FFFFFF")
+                   + shaded_cell(f"{experience.get('Header')}", EMPLOYMENT_WIDTHS[1], "FFFFFF") + "</w:tr>"
+                   for experience in experiences)
+    return EMPLOYMENT_TABLE.format(grid=grid, rows=rows)
+
+
+def heading(text, line=True, space_before=6, space_after=4):
+    run = HEADING_RUN.format(text=run_text(text)) if text else ""
+    return HEADING.format(before=twips(space_before), after=twips(space_after), border=HEADING_BORDER if line else "", run=run)
+
+
+def paragraph(text, alignment="left", space_before=4, space_after=4):
+    run = f"<w:r>{run_text(text)}</w:r>" if text else ""
+    return PARAGRAPH.format(before=twips(space_before), after=twips(space_after), alignment=alignment, run=run)
+
+
+def parse_elements(elements):
+    """
+    Parses a list of sibling elements into python-docx's element classes.
+
+    Each element declares the namespace itself: lxml moves an element whose
+    descendants resolve it on an ancestor in quadratic time, a large table
+    would take longer to move into the document than to build.
+    """
+    xml = "".join(ELEMENT_TAG.sub(rf"\1 {nsdecls('w')}", element, count=1) for element in elements)
+    return list(parse_xml(f"<fragment>{xml}</fragment>"))
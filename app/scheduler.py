@@ -0,0 +1,197 @@
+"""
+path: app/scheduler.py
+
+This file contains the priority scheduler that hands out render slots and
+LibreOffice workers to interactive and bulk traffic in weighted fair shares,
+so a single export does not queue behind a large batch.
+"""
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from app.config import settings
+from app.metrics import registry, Gauge, Histogram
+from app.utils import ConversionCancelled
+
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITY_CLASSES = [INTERACTIVE, BULK]
+
+# the priority class and client of the render running in this context
+render_priority = contextvars.ContextVar("render_priority", default=INTERACTIVE)
+render_client = contextvars.ContextVar("render_client", default=None)
+
+SCHEDULER_WAIT_SECONDS = registry.register(Histogram("asi_scheduler_wait_seconds", "Time spent waiting for a render slot or LibreOffice worker by priority class"))
+SCHEDULER_WAITING = registry.register(Gauge("asi_scheduler_waiting", "Renders and conversions waiting for the scheduler by priority class"))
+
+
+def parse_mapping(value):
+    """
+    Parses 'name:value,name:value' into a dict
+    """
+    mapping = {}
+    for item in value.split(","):
+        if item.strip():
+            name, _, item_value = item.rpartition(":")
+            mapping[name.strip()] = item_value.strip()
+    return mapping
+
+
+def priority_weights():
+    """
+    Returns the weight of every priority class from PRIORITY_WEIGHTS, 1 for a class it leaves out
+    """
+    weights = {name: float(weight) for name, weight in parse_mapping(settings.PRIORITY_WEIGHTS).items()}
+    return {name: weights.get(name, 1.0) for name in PRIORITY_CLASSES}
+
+
+def resolve_priority(priority=None, api_key=None, default=INTERACTIVE):
+    """
+    Returns the priority class of a request: the class of its API key in API_KEY_PRIORITIES,
+    else the class it asked for, else the default of the route
+    """
+    if api_key:
+        priority = parse_mapping(settings.API_KEY_PRIORITIES).get(api_key, priority)
+    priority = priority or default
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError("The priority should be either 'interactive' or 'bulk'")
+    return priority
+
+
+class Waiter:
+    def __init__(self, client):
+        self.client = client
+        self.granted = False
+
+
+class PriorityScheduler:
+    """
+    Grants up to slots concurrent holders, picking the next waiter with stride scheduling.
+
+    Every priority class advances its pass by 1/weight per grant and the waiting
+    class with the lowest pass goes next, so under contention the classes get
+    slots in proportion to their weights and a lighter class is never starved.
+    Within a class waiters are served in arrival order, skipping the waiters of
+    a client already holding client_limit slots (0 for no limit).
+    """
+    def __init__(self, slots, weights, client_limit=0, name="render"):
+        self.slots = slots
+        self.weights = weights
+        self.client_limit = client_limit
+        self.name = name
+        self._running = 0
+        self._clients = {}
+        self._queues = {priority: deque() for priority in weights}
+        self._passes = {priority: 0.0 for priority in weights}
+        self._clock = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def running(self):
+        return self._running
+
+    def waiting(self, priority):
+        return len(self._queues[priority])
+
+    def _eligible(self, queue):
+        if not self.client_limit:
+            return queue[0] if queue else None
+        for waiter in queue:
+            if waiter.client is None or self._clients.get(waiter.client, 0) < self.client_limit:
+                return waiter
+        return None
+
+    def _dispatch(self):
+        """
+        Grants the free slots to the waiters that go next, called with the condition held
+        """
+        granted = False
+        while self._running < self.slots:
+            candidates = [(self._passes[priority], index, priority, waiter)
+                          for index, (priority, queue) in enumerate(self._queues.items())
+                          if (waiter := self._eligible(queue)) is not None]
+            if not candidates:
+                break
+            passes, _, priority, waiter = min(candidates, key=lambda candidate: candidate[:2])
+            self._queues[priority].remove(waiter)
+            self._clock = passes
+            self._passes[priority] += 1 / self.weights[priority]
+            self._running += 1
+            if waiter.client is not None:
+                self._clients[waiter.client] = self._clients.get(waiter.client, 0) + 1
+            waiter.granted = granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def _set_waiting(self, priority):
+        SCHEDULER_WAITING.set(len(self._queues[priority]), scheduler=self.name, priority=priority)
+
+    def acquire(self, priority, client=None, deadline=None, cancel=None):
+        """
+        Waits for a slot until the monotonic deadline, returns False when it passed or cancel was set first
+        """
+        start = time.monotonic()
+        waiter = Waiter(client)
+        with self._condition:
+            queue = self._queues[priority]
+            if not queue:
+                # a class that was idle starts from the current pass, it does not get to spend the turns it skipped
+                self._passes[priority] = max(self._passes[priority], self._clock)
+            queue.append(waiter)
+            self._dispatch()
+            while not waiter.granted:
+                if cancel is not None and cancel.is_set() or deadline is not None and time.monotonic() >= deadline:
+                    queue.remove(waiter)
+                    self._set_waiting(priority)
+                    return False
+                self._set_waiting(priority)
+                # woken by every grant, the timeout only rechecks the cancel event and the deadline
+                self._condition.wait(0.25 if deadline is None else max(min(deadline - time.monotonic(), 0.25), 0))
+            self._set_waiting(priority)
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - start, scheduler=self.name, priority=priority)
+        return True
+
+    def release(self, client=None):
+        with self._condition:
+            self._running -= 1
+            if client is not None:
+                self._clients[client] -= 1
+                if not self._clients[client]:
+                    del self._clients[client]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, cancel=None):
+        """
+        Holds a slot for the priority class and client of the current context, waiting for it as long as it takes
+        """
+        priority, client = render_priority.get(), render_client.get()
+        if not self.acquire(priority, client, cancel=cancel):
+            raise ConversionCancelled("The render was cancelled while waiting for its turn")
+        try:
+            yield
+        finally:
+            self.release(client)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_render_scheduler():
+    """
+    Returns the process wide scheduler of the RENDER_WORKERS render slots, creating it on first use
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = PriorityScheduler(settings.RENDER_WORKERS, priority_weights(),
+                                               client_limit=settings.CLIENT_CONCURRENCY, name="render")
+    return _scheduler
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 from pydantic import BaseModel, Field
 
 class Qualification(BaseModel):
@@ -40,3 +40,28 @@ class RawProfile(BaseModel):
     ExperienceYears: str
     ExperienceHeader: str
     ExperienceContent: str
+
+# the parsed entries are tuples, a parse creates one per language and experience
+class ParsedLanguage(NamedTuple):
+    Language: str
+    Proficiency: str
+
+class ParsedExperience(NamedTuple):
+    DateRange: str
+    Header: str
+    Content: str
+    IsSelected: bool = True
+
+class ParsedProfile(BaseModel):
+    Name: str
+    Title: str
+    Qualifications: List[str]
+    TechnicalSkills: List[str]
+    Languages: List[ParsedLanguage]
+    Countries: List[str]
+    SummaryOfExperience: List[str]
+    Experiences: List[ParsedExperience]
+
+class BatchRequest(BaseModel):
+    Profiles: List[Profile] = []
+    RawProfiles: List[RawProfile] = []
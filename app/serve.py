@@ -0,0 +1,226 @@
+"""
+path: app/serve.py
+
+This file contains the production server: gunicorn preforks uvicorn workers from a
+parent that has already imported the heavy modules and rendered a sample CV,
+so the workers share the modules, the document skeleton and the section fragments
+copy-on-write. Every worker starts and warms
+its own LibreOffice instances before it accepts traffic.
+
+    python -m app.serve --workers 4
+"""
+import os
+import gc
+import time
+import shutil
+import logging
+import argparse
+import importlib
+import tempfile
+
+from app.config import settings
+from app.metrics import registry
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+logger = logging.getLogger(__name__)
+
+# imported in the parent so no worker pays for them, docx2pdf is only imported on windows when converting
+PRELOAD_MODULES = [
+    "lxml.etree",
+    "docx",
+    "fpdf",
+    "google.cloud.storage",
+    "google.oauth2.service_account",
+    "google.auth.transport.requests",
+    "main",
+]
+
+
+def warm_up_profile():
+    """
+    Returns the small RawProfile rendered to warm up the parser, the section builders and the fragment cache
+    """
+    from app.schema import RawProfile
+    return RawProfile(
+        Name="Warm Up",
+        Title="Warm Up",
+        Qualifications="• MSc Warm Up, University, 2000",
+        TechnicalSkills=["Warm Up"],
+        Languages="English (excellent)",
+        Countries=["Warm Up"],
+        SummaryOfExperience="Warm up.",
+        ExperienceYears="2000-2001",
+        ExperienceHeader="Warm Up Lead, Organisation, City",
+        ExperienceContent="Warm up.",
+    )
+
+
+def warm_render():
+    """
+    Renders the warm up profile the way the routes do and returns its docx bytes
+    """
+    from app.pdf import NativePdfUnavailable
+    from app.profiles import build_profile_cv
+
+    asi_cv = build_profile_cv(warm_up_profile())
+    try:
+        asi_cv.render("pdf", pdf_engine="native")
+    except NativePdfUnavailable:
+        pass
+    return asi_cv.render("docx")
+
+
+def preload():
+    """
+    Imports the application and renders a sample CV in the parent process
+    """
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning("Could not preload %s: %s", module, e)
+    from app.asi import ASI_CV
+    ASI_CV.skeleton()
+    try:
+        warm_render()
+    except Exception as e:
+        logger.warning("Could not render the warm up CV in the parent: %s", e)
+    # objects that survive until the fork are never collected, so the collector does not
+    # write to their pages and they stay shared with the workers
+    gc.collect()
+    gc.freeze()
+
+
+def warm_up():
+    """
+    Renders the warm up CV and converts it once on every LibreOffice worker of this process
+    """
+    from app.converter import get_converter_pool, ConversionError
+
+    docx_bytes = warm_render()
+    if os.name == "nt" or settings.PDF_ENGINE == "native":
+        return
+    if shutil.which(settings.LIBREOFFICE_BINARY) is None:
+        logger.warning("%s not found, LibreOffice is not warmed up", settings.LIBREOFFICE_BINARY)
+        return
+    pool = get_converter_pool()
+    with tempfile.TemporaryDirectory(prefix="asi-warm-up-") as scratch:
+        docx_paths = []
+        for index in range(pool.size):
+            docx_path = os.path.join(scratch, f"warm-up-{index}.docx")
+            with open(docx_path, "wb") as file:
+                file.write(docx_bytes)
+            docx_paths.append(docx_path)
+        try:
+            pool.convert_many(docx_paths, scratch)
+        except ConversionError as e:
+            logger.warning("LibreOffice warm up failed, the first conversions will start it: %s", e)
+
+
+def prepare_metrics_dir():
+    """
+    Empties METRICS_DIR, or creates a temporary one, for the processes of this server to share their metrics in
+    """
+    if settings.METRICS_DIR:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        for name in os.listdir(settings.METRICS_DIR):
+            if name.endswith(".json"):
+                os.remove(os.path.join(settings.METRICS_DIR, name))
+    else:
+        settings.METRICS_DIR = tempfile.mkdtemp(prefix="asi-metrics-")
+    # the spawned job workers read their settings from the environment
+    os.environ["METRICS_DIR"] = settings.METRICS_DIR
+
+
+def pre_fork(server, worker):
+    """
+    Gives the worker the lowest slot no live worker holds, a replaced worker takes over the slot of the dead one
+    """
+    used = {getattr(other, "slot", None) for other in server.WORKERS.values()}
+    worker.slot = next(slot for slot in range(len(used) + 1) if slot not in used)
+
+
+def post_fork(server, worker):
+    # every worker owns its LibreOffice instances, keep the ports of each slot and its job workers apart
+    settings.CONVERTER_BASE_PORT = settings.CONVERTER_BASE_PORT + worker.slot * (settings.JOB_WORKERS + 1) * settings.CONVERTER_POOL_SIZE
+    # the job queue is shared, one worker runs the job processes for all of them
+    if worker.slot:
+        settings.JOB_WORKERS = 0
+    # the samples of the parent, e.g. of the warm up render, are not the worker's
+    registry.reset()
+    registry.start_directory(settings.METRICS_DIR, settings.METRICS_INTERVAL)
+
+
+def post_worker_init(worker):
+    if not settings.WARMUP:
+        return
+    start = time.perf_counter()
+    try:
+        warm_up()
+    except Exception as e:
+        logger.error("Warm up of worker %s failed: %s", worker.slot, e)
+        return
+    logger.info("Worker %s warmed up in %.2fs, LibreOffice ports from %s", worker.slot, time.perf_counter() - start,
+                settings.CONVERTER_BASE_PORT)
+
+
+def worker_exit(server, worker):
+    """
+    Stops the job processes of a worker that exits without the application shutdown, e.g. after a timeout,
+    and writes its last metrics
+    """
+    from app.jobs import stop_job_workers
+    stop_job_workers()
+    registry.write()
+
+
+if BaseApplication is not None:
+    class Server(BaseApplication):
+        """
+        Runs main:app in gunicorn with uvicorn workers and the hooks above
+        """
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from main import app
+            return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=settings.PORT)
+    parser.add_argument("--workers", type=int, default=settings.WEB_WORKERS, help="0 for one per CPU core")
+    args = parser.parse_args()
+    if BaseApplication is None:
+        raise SystemExit("The production server needs gunicorn, install it with 'pip install gunicorn' "
+                         "or run 'uvicorn main:app' instead")
+    prepare_metrics_dir()
+    preload()
+    Server({
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers or os.cpu_count() or 1,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "timeout": settings.WEB_TIMEOUT,
+        "graceful_timeout": settings.WEB_TIMEOUT,
+        "pre_fork": pre_fork,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+path: app/storage.py
+
+This file contains the storage backends CVs are uploaded to, selected with STORAGE_BACKEND:
+Google Cloud Storage, or the local filesystem under OUTPUT_DIR served by the app itself.
+"""
+import io
+import os
+import re
+import shutil
+import logging
+import tempfile
+import threading
+from datetime import timedelta
+from urllib.parse import quote
+
+import requests
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.oauth2 import service_account
+
+from app.config import settings
+from app.metrics import stage
+
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ["gcs", "local"]
+# everything but letters, digits, dots, dashes and underscores is replaced in object names
+UNSAFE_CHARACTERS = re.compile(r"[^\w.-]+")
+
+_clients = {}
+_buckets = {}
+_lock = threading.RLock()
+
+
+def get_storage_client(credentials=None):
+    """
+    Returns a storage client for the service account file, built once per process.
+
+    The client shares one AuthorizedSession, which refreshes the access token
+    when it expires and keeps a connection pool sized for the render workers.
+    """
+    credentials = credentials or settings.CREDENTIALS
+    client = _clients.get(credentials)
+    if client is None:
+        with _lock:
+            client = _clients.get(credentials)
+            if client is None:
+                logger.info("Creating storage client for %s", credentials)
+                service_credentials = service_account.Credentials.from_service_account_file(
+                    credentials, scopes=["https://www.googleapis.com/auth/devstorage.read_write"])
+                session = AuthorizedSession(service_credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=settings.RENDER_WORKERS,
+                                                        pool_maxsize=settings.RENDER_WORKERS)
+                session.mount("https://", adapter)
+                client = storage.Client(project=service_credentials.project_id,
+                                        credentials=service_credentials, _http=session)
+                _clients[credentials] = client
+    return client
+
+
+def get_bucket(bucket_name=None, credentials=None):
+    """
+    Returns a bucket handle without fetching the bucket metadata
+    """
+    bucket_name = bucket_name or settings.BUCKET_NAME
+    credentials = credentials or settings.CREDENTIALS
+    key = (bucket_name, credentials)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = get_storage_client(credentials).bucket(bucket_name)
+                _buckets[key] = bucket
+    return bucket
+
+
+def object_name(folder, name, file_id, file_format):
+    """
+    Returns the object name of a CV, with the name reduced to characters that need no escaping in a url
+    """
+    name = UNSAFE_CHARACTERS.sub("-", name).strip("-.") or "CV"
+    return f"{folder}/{name}-ASI-CV-Export-{file_id}.{file_format}"
+
+
+class GCSStorage:
+    """
+    Uploads to Google Cloud Storage with a single request per file.
+
+    The public read ACL and the download name are sent with the upload itself.
+    With signed=True the object stays private and its url is signed locally
+    with the service account key, for buckets with uniform access that
+    refuse object ACLs. Neither needs a call after the upload.
+    """
+    def __init__(self, signed=False, expiry=7 * 24 * 60 * 60):
+        self.signed = signed
+        self.expiry = expiry
+
+    def upload(self, file, blob_name, content_type, bucket_name=None, credentials=None, filename=None):
+        """
+        Files up to STREAM_UPLOAD_THRESHOLD go in a single request, larger ones
+        are streamed through a resumable upload in UPLOAD_CHUNK_SIZE chunks.
+        """
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        blob = get_bucket(bucket_name, credentials).blob(blob_name)
+        if filename:
+            blob.content_disposition = f"inline; filename*=UTF-8''{quote(filename)}"
+        acl = None if self.signed else "publicRead"
+        if size <= settings.STREAM_UPLOAD_THRESHOLD:
+            # a resumable session would cost an extra round trip for a typical CV
+            blob.upload_from_file(file, size=size, content_type=content_type, predefined_acl=acl)
+        else:
+            with blob.open("wb", content_type=content_type, chunk_size=settings.UPLOAD_CHUNK_SIZE,
+                           ignore_flush=True, predefined_acl=acl) as writer:
+                shutil.copyfileobj(file, writer, settings.UPLOAD_CHUNK_SIZE)
+        return self.url(blob_name, bucket_name, credentials)
+
+    def url(self, blob_name, bucket_name=None, credentials=None):
+        blob = get_bucket(bucket_name, credentials).blob(blob_name)
+        if self.signed:
+            return blob.generate_signed_url(version="v4", expiration=timedelta(seconds=self.expiry), method="GET")
+        return blob.public_url
+
+
+class LocalStorage:
+    """
+    Writes uploads under root, one directory per bucket, and returns their url under /files of the app
+    """
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_name, bucket_name=None):
+        parts = [bucket_name or settings.BUCKET_NAME] + blob_name.split("/")
+        if any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"Invalid object name {blob_name}")
+        return os.path.join(self.root, *parts)
+
+    def upload(self, file, blob_name, content_type, bucket_name=None, credentials=None, filename=None):
+        path = self.path(blob_name, bucket_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to its final path and renamed, a reader never sees half a file
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        file.seek(0)
+        try:
+            with os.fdopen(descriptor, "wb") as target:
+                shutil.copyfileobj(file, target, settings.UPLOAD_CHUNK_SIZE)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return self.url(blob_name, bucket_name, credentials)
+
+    def url(self, blob_name, bucket_name=None, credentials=None):
+        return f"{self.base_url}/files/{quote(bucket_name or settings.BUCKET_NAME)}/{quote(blob_name)}"
+
+
+_storage = None
+
+
+def local_storage_dir():
+    return settings.LOCAL_STORAGE_DIR or os.path.join(settings.OUTPUT_DIR, "files")
+
+
+def get_storage():
+    """
+    Returns the process wide storage backend selected by STORAGE_BACKEND, creating it on first use
+    """
+    global _storage
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                if settings.STORAGE_BACKEND not in STORAGE_BACKENDS:
+                    raise ValueError("The storage backend should be either 'gcs' or 'local'")
+                if settings.STORAGE_BACKEND == "local":
+                    _storage = LocalStorage(local_storage_dir(), settings.PUBLIC_URL or f"http://localhost:{settings.PORT}")
+                else:
+                    _storage = GCSStorage(signed=settings.SIGNED_URLS, expiry=settings.SIGNED_URL_EXPIRY)
+    return _storage
+
+
+def upload_file(file, blob_name, content_type, bucket_name=None, credentials=None, filename=None):
+    """
+    Uploads bytes or a binary file to the storage backend and returns its url, filename is the name it downloads as
+    """
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    with stage("upload"):
+        return get_storage().upload(file, blob_name, content_type, bucket_name, credentials, filename=filename)
+
+
+def storage_url(blob_name, bucket_name=None, credentials=None):
+    """
+    Returns the url of an uploaded object, signed afresh when urls are signed
+    """
+    return get_storage().url(blob_name, bucket_name, credentials)
@@ -1,10 +1,100 @@
-import subprocess
 import os
+import json
+import time
+import signal
+import logging
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionError(Exception):
+    """
+    Raised when a docx file could not be converted to pdf
+    """
+
+
+class ConversionTimeout(ConversionError):
+    """
+    Raised when a conversion did not finish before its deadline, its processes are killed
+    """
+
+
+class ConversionCancelled(ConversionError):
+    """
+    Raised when a conversion is stopped because the client that asked for it went away
+    """
+
+
+def kill_process_group(process):
+    """
+    Kills a process started with start_new_session and everything it spawned, then reaps it
+    """
+    try:
+        if os.name == 'nt':
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.wait()
+
+
+def wait_process(process, deadline=None, cancel=None, poll_interval=0.1):
+    """
+    Waits for a process until the monotonic deadline or until the cancel event is set, killing it on either
+    """
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            kill_process_group(process)
+            raise ConversionTimeout("The conversion to pdf timed out")
+        if cancel is not None and cancel.is_set():
+            kill_process_group(process)
+            raise ConversionCancelled("The conversion to pdf was cancelled")
+        try:
+            return process.wait(timeout=poll_interval if remaining is None else min(poll_interval, remaining))
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def pdf_filter(filter_options=None):
+    """
+    Returns the --convert-to argument exporting pdf with the writer_pdf_Export filter options, as JSON (LibreOffice 7.4+)
+    """
+    if not filter_options:
+        return 'pdf'
+    types = {bool: 'boolean', int: 'long', str: 'string'}
+    options = {name: {'type': types[type(value)], 'value': str(value).lower() if isinstance(value, bool) else str(value)}
+               for name, value in filter_options.items()}
+    return 'pdf:writer_pdf_Export:' + json.dumps(options, separators=(',', ':'))
+
+
+def convert_docx_to_pdf(docx_path, pdf_path, profile_dir=None, timeout=None, binary='libreoffice', cancel=None, filter_options=None):
+    convert_docx_files_to_pdf([docx_path], os.path.dirname(pdf_path), profile_dir=profile_dir, timeout=timeout, binary=binary, cancel=cancel,
+                              filter_options=filter_options)
+    if not os.path.exists(pdf_path):
+        raise ConversionError(f"LibreOffice did not write {os.path.basename(pdf_path)}")
+
+
+def convert_docx_files_to_pdf(docx_paths, outdir, profile_dir=None, timeout=None, binary='libreoffice', cancel=None, filter_options=None):
+    """
+    Converts every docx file into outdir with a single soffice invocation.
 
-def convert_docx_to_pdf(docx_path, pdf_path):
+    soffice runs in its own process group so a hung or cancelled conversion
+    is killed together with the processes the launcher started.
+    """
+    command = [binary]
+    if profile_dir is not None:
+        # a private profile keeps concurrent conversions from colliding on the shared one
+        command.append(f'-env:UserInstallation={Path(profile_dir).as_uri()}')
+    command += ['--headless', '--convert-to', pdf_filter(filter_options), *docx_paths, '--outdir', outdir]
+    deadline = time.monotonic() + timeout if timeout else None
     try:
-        subprocess.run(['libreoffice', '--headless', '--convert-to', 'pdf', docx_path, '--outdir', os.path.dirname(pdf_path)], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error during conversion: {e}")
-        return False
-    return True
\ No newline at end of file
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        raise ConversionError(f"Could not start {binary}: {e}")
+    returncode = wait_process(process, deadline=deadline, cancel=cancel)
+    if returncode != 0:
+        raise ConversionError(f"{binary} exited with status {returncode}")
@@ -0,0 +1,110 @@
+"""
+path: benchmarks/bench_build.py
+
+Times building the document of profiles with a growing number of experiences, the
+python-docx cell by cell builders the CV used to be built with against the single
+pass writer of app.rows. Every run starts from an empty fragment cache, so every
+section is built. The time per experience of the writer should stay flat as the
+employment history grows.
+
+    python -m benchmarks.bench_build --sizes 10,100,1000 --output bench/build.json
+"""
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+
+from app.asi import ASI_CV
+from app.cache import get_fragment_cache
+from app.profiles import build_profile_cv
+from benchmarks.profiles import make_raw_profile
+
+
+def legacy_build(asi_cv):
+    """
+    ASI_CV.build_document before app.rows, without the fragment cache
+    """
+    table = asi_cv.doc.tables[0]
+    asi_cv.add_table_row_with_two_columns(table, ["Name", "Position"], [[asi_cv.name], [asi_cv.title]], 'D9E2F3', bold=False, bullet=False)
+    for heading, items, bullet in asi_cv.header_rows():
+        asi_cv.add_table_row(table, heading, items, 'D9E2F3', bold=False, bullet=bullet)
+    asi_cv.add_heading("Summary of Experience")
+    for summary in asi_cv.summary_of_experience:
+        asi_cv.add_paragraph(summary, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
+    asi_cv.add_heading("Employment History")
+    asi_cv.add_employment_table()
+    asi_cv.add_heading("Selected Experience")
+    for experience in asi_cv.selected_experiences():
+        asi_cv.add_heading(experience["Header"] + " (" + experience["Date Range"] + ")", line=False, space_before=4, space_after=0)
+        asi_cv.add_paragraph(experience["Content"], alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY, space_before=0, space_after=4)
+
+
+def rows_build(asi_cv):
+    asi_cv.build_document()
+
+
+def timed(build, profile, repeat):
+    timings = []
+    for _ in range(repeat):
+        asi_cv = build_profile_cv(profile)
+        get_fragment_cache().clear()
+        # like timeit, a collection landing in one of the runs is not timed
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            build(asi_cv)
+            timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            gc.enable()
+    return {"mean_ms": statistics.mean(timings), "min_ms": min(timings)}
+
+
+def run(sizes, repeat=3):
+    ASI_CV.skeleton()
+    runs = []
+    for size in sizes:
+        profile = make_raw_profile(experiences=size, content_words=60)
+        result = {"size": size}
+        for name, build in (("legacy", legacy_build), ("rows", rows_build)):
+            result[name] = timed(build, profile, repeat)
+            result[name]["per_experience_ms"] = result[name]["min_ms"] / size
+        print(f"{size:>6} experiences: legacy {result['legacy']['min_ms']:.1f}ms "
+              f"({result['legacy']['per_experience_ms']:.3f}ms each), rows {result['rows']['min_ms']:.1f}ms "
+              f"({result['rows']['per_experience_ms']:.3f}ms each)", file=sys.stderr)
+        runs.append(result)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "repeat": repeat,
+        },
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated numbers of experiences")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+    results = run([int(size) for size in args.sizes.split(",")], repeat=args.repeat)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+path: benchmarks/bench_parser.py
+
+Times app.parser against the splitting that used to run inline in build_raw_cv, on
+RawProfile exports of growing size: "parse" is the splitting alone and "build" is
+the whole RawProfile to ASI_CV step, the old inline code against build_raw_cv.
+
+    python -m benchmarks.bench_parser --sizes 10,1000,10000 --output bench/parser.json
+"""
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+from app.asi import ASI_CV
+from app.parser import parse_raw_profile
+from app.profiles import build_raw_cv
+from benchmarks.profiles import make_raw_profile
+
+
+def legacy_parse(profile):
+    """
+    The splitting of build_raw_cv before app.parser, collecting into lists instead of an ASI_CV
+    """
+    qualifications = profile.Qualifications.replace("•", "").split("|")
+    languages = []
+    for language in profile.Languages.split(","):
+        language, proficiency = language.split(" (")
+        proficiency = proficiency.replace(")", "")
+        languages.append((language, proficiency))
+    summaries = profile.SummaryOfExperience.split("||")
+    experiences_years = profile.ExperienceYears.split(",")
+    experiences_headers = profile.ExperienceHeader.split("|")
+    experiences_content = profile.ExperienceContent.split("#")
+    if len(experiences_years) > len(experiences_headers):
+        experiences_headers = experiences_headers + [""] * (len(experiences_years) - len(experiences_headers))
+    if len(experiences_headers) > len(experiences_years):
+        experiences_years = experiences_years + [""] * (len(experiences_headers) - len(experiences_years))
+    experiences = []
+    for i, experience_header in enumerate(experiences_headers):
+        if len(experiences_years) > i:
+            experiences.append((experiences_years[i], experience_header, experiences_content[i]))
+    return qualifications, languages, summaries, experiences
+
+
+def legacy_build(profile):
+    """
+    build_raw_cv before app.parser
+    """
+    asi_cv = ASI_CV()
+    asi_cv._add_name_title(profile.Name, profile.Title)
+    for qualification in profile.Qualifications.replace("•", "").split("|"):
+        asi_cv._add_raw_qualification(qualification)
+    for skill in profile.TechnicalSkills:
+        asi_cv._add_technical_skill(skill)
+    for language in profile.Languages.split(","):
+        language, proficiency = language.split(" (")
+        asi_cv._add_language(language, proficiency.replace(")", ""))
+    for country in profile.Countries:
+        asi_cv._add_country(country)
+    for summary in profile.SummaryOfExperience.split("||"):
+        asi_cv._add_summary_of_experience(summary)
+    experiences_years = profile.ExperienceYears.split(",")
+    experiences_headers = profile.ExperienceHeader.split("|")
+    experiences_content = profile.ExperienceContent.split("#")
+    if len(experiences_years) > len(experiences_headers):
+        experiences_headers = experiences_headers + [""] * (len(experiences_years) - len(experiences_headers))
+    if len(experiences_headers) > len(experiences_years):
+        experiences_years = experiences_years + [""] * (len(experiences_headers) - len(experiences_years))
+    for i, experience_header in enumerate(experiences_headers):
+        if len(experiences_years) > i:
+            asi_cv._add_raw_experience(experiences_years[i], experience_header, experiences_content[i])
+    return asi_cv
+
+
+def timed(func, profile, repeat):
+    timings = []
+    # like timeit, a collection landing in one of the runs is not timed
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(profile)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        gc.enable()
+    return {"mean_ms": statistics.mean(timings), "min_ms": min(timings)}
+
+
+def run(sizes, repeat=5):
+    runs = []
+    for size in sizes:
+        # every field grows with the size so the language and qualification splitting is timed too
+        profile = make_raw_profile(experiences=size, qualifications=size, languages=size, summaries=max(3, size // 10),
+                                   content_words=40)
+        result = {"size": size}
+        for step, legacy, current in (("parse", legacy_parse, parse_raw_profile), ("build", legacy_build, build_raw_cv)):
+            result[step] = {"legacy": timed(legacy, profile, repeat), "parser": timed(current, profile, repeat)}
+            print(f"{size:>7} entries {step}: legacy {result[step]['legacy']['min_ms']:.2f}ms, "
+                  f"parser {result[step]['parser']['min_ms']:.2f}ms", file=sys.stderr)
+        runs.append(result)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "repeat": repeat,
+        },
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,10000", help="comma separated numbers of entries per field")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+    results = run([int(size) for size in args.sizes.split(",")], repeat=args.repeat)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
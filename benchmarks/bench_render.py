@@ -0,0 +1,187 @@
+"""
+path: benchmarks/bench_render.py
+
+Times every stage of the render pipeline against synthetic profiles of growing size
+and records the peak traced memory of each stage, and the size of the pdf of every
+export profile next to its conversion time.
+
+    python -m benchmarks.bench_render --sizes 1,10,100 --output bench.json
+    python -m benchmarks.bench_render --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import statistics
+import tracemalloc
+
+from app.cache import get_fragment_cache
+from app.config import settings
+from app.converter import PDF_PROFILES
+from app.pdf import FPDF, render_pdf
+from app.profiles import build_profile_cv
+from app.storage import upload_file
+from benchmarks.profiles import make_profile, make_raw_profile
+
+
+def use_local_storage():
+    """
+    Sends the uploads to the local storage backend in a temporary directory, so they are timed without network
+    """
+    settings.STORAGE_BACKEND = "local"
+    settings.LOCAL_STORAGE_DIR = tempfile.mkdtemp(prefix="asi-bench-storage-")
+
+
+def measure(func, repeat):
+    """
+    Runs func() repeat times and returns timing stats in ms and the peak traced memory in KiB.
+
+    tracemalloc slows allocations down, so the peak comes from one extra traced run.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "mean_ms": statistics.mean(timings),
+        "min_ms": min(timings),
+        "max_ms": max(timings),
+        "peak_kib": peak / 1024,
+    }
+
+
+def bench_profile(profile, repeat=3, convert=True):
+    """
+    Returns the stats of every stage for one profile
+    """
+    results = {}
+    results["init"] = measure(lambda: build_profile_cv(profile), repeat)
+
+    def add_table():
+        cv = build_profile_cv(profile)
+        cv.add_table()
+    results["add_table"] = measure(add_table, repeat)
+
+    def add_employment_table():
+        cv = build_profile_cv(profile)
+        cv.add_employment_table()
+    results["add_employment_table"] = measure(add_employment_table, repeat)
+
+    def build():
+        # every section is built, as for a profile seen for the first time
+        get_fragment_cache().clear()
+        build_profile_cv(profile).build_document()
+    results["build"] = measure(build, repeat)
+
+    edits = iter(range(repeat + 1))
+    def build_edited():
+        # one added skill only rebuilds the header section, the rest comes from the fragment cache
+        edited = profile.model_copy(update={"TechnicalSkills": profile.TechnicalSkills + [f"Skill {next(edits)}"]})
+        build_profile_cv(edited).build_document()
+    build_profile_cv(profile).build_document()
+    results["build_edited"] = measure(build_edited, repeat)
+
+    built = build_profile_cv(profile)
+    built.build_document()
+    results["serialize"] = measure(built.save_docx, repeat)
+    docx_bytes = built.save_docx()
+    results["upload"] = measure(lambda: upload_file(docx_bytes, "bench/cv.docx", "application/docx"), repeat)
+    file_format = "pdf" if convert else "docx"
+    if convert:
+        for pdf_profile in PDF_PROFILES:
+            name = "convert" if pdf_profile == "default" else f"convert_{pdf_profile}"
+            results[name] = measure(lambda: built.save_pdf(pdf_profile=pdf_profile), repeat)
+            results[name]["bytes"] = len(built.save_pdf(pdf_profile=pdf_profile))
+    if FPDF is not None:
+        results["convert_native"] = measure(lambda: render_pdf(built), repeat)
+        results["convert_native"]["bytes"] = len(render_pdf(built))
+
+    def generate():
+        build_profile_cv(profile).generate_cv(file_format=file_format, output_type="url",
+                                              bucket_name=settings.BUCKET_NAME, folder="bench",
+                                              credentials=settings.CREDENTIALS)
+    results["generate_cv"] = measure(generate, repeat)
+    return results
+
+
+def run(sizes, repeat=3, kind="raw", convert=None):
+    if convert is None:
+        convert = shutil.which(settings.LIBREOFFICE_BINARY) is not None
+    use_local_storage()
+    make = make_raw_profile if kind == "raw" else make_profile
+    # build the document skeleton once so it is not charged to the first size
+    build_profile_cv(make(experiences=1))
+    runs = []
+    for size in sizes:
+        profile = make(experiences=size, qualifications=max(3, size // 10), skills=max(10, size // 5))
+        started = time.perf_counter()
+        stages = bench_profile(profile, repeat=repeat, convert=convert)
+        runs.append({"experiences": size, "stages": stages})
+        print(f"{size:>6} experiences: " + ", ".join(
+            f"{stage} {stats['mean_ms']:.1f}ms" for stage, stats in stages.items())
+            + f" ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "kind": kind,
+            "repeat": repeat,
+            "convert": convert,
+        },
+        "runs": runs,
+    }
+
+
+def compare(current, baseline):
+    """
+    Prints the ratio of every stage mean against a previous result file
+    """
+    previous = {run["experiences"]: run["stages"] for run in baseline["runs"]}
+    for run in current["runs"]:
+        stages = previous.get(run["experiences"])
+        if stages is None:
+            continue
+        for stage, stats in run["stages"].items():
+            if stage not in stages:
+                continue
+            ratio = stats["mean_ms"] / stages[stage]["mean_ms"] if stages[stage]["mean_ms"] else float("nan")
+            flag = "  <-- slower" if ratio > 1.1 else ""
+            print(f"{run['experiences']:>6} {stage:<22} {stages[stage]['mean_ms']:>9.1f}ms -> "
+                  f"{stats['mean_ms']:>9.1f}ms  x{ratio:.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,10,100", help="comma separated numbers of experiences")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--kind", choices=["raw", "profile"], default="raw")
+    parser.add_argument("--no-convert", action="store_true", help="skip the LibreOffice stages")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", help="a previous result file to compare against")
+    args = parser.parse_args()
+    results = run([int(size) for size in args.sizes.split(",")], repeat=args.repeat, kind=args.kind,
+                  convert=False if args.no_convert else None)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
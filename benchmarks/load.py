@@ -0,0 +1,128 @@
+"""
+path: benchmarks/load.py
+
+HTTP load driver for the FastAPI app. Sends requests with bounded concurrency and
+reports p50/p95/p99 latency and throughput.
+
+    python -m benchmarks.load --requests 200 --concurrency 16
+    python -m benchmarks.load --url http://localhost:8000 --endpoint /raw_data --output load.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+
+import httpx
+
+from benchmarks.profiles import make_raw_profile, make_profile
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(client, endpoint, payloads, params, concurrency):
+    """
+    Posts every payload with at most `concurrency` requests in flight, returns (latencies, statuses, elapsed)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def send(payload):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, params=params, json=payload)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(payload) for payload in payloads))
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def run(url=None, endpoint="/raw_data", requests=100, concurrency=8, file_format="pdf", output_type="file",
+              experiences=10, unique=True, timeout=120):
+    make = make_profile if endpoint == "/" else make_raw_profile
+    # distinct names keep the render cache from answering every request after the first
+    payloads = [make(experiences=experiences, name=f"Load Test {index if unique else 0}").model_dump(mode="json")
+                for index in range(requests)]
+    params = {"file_format": file_format, "output_type": output_type}
+    if url is None:
+        # drive the app in-process, uploads go to the local storage backend
+        from benchmarks.bench_render import use_local_storage
+        use_local_storage()
+        from main import app
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://app"
+    else:
+        transport = None
+        base_url = url
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=timeout) as client:
+        latencies, statuses, elapsed = await drive(client, endpoint, payloads, params, concurrency)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "target": url or "in-process",
+            "endpoint": endpoint,
+            "requests": requests,
+            "concurrency": concurrency,
+            "file_format": file_format,
+            "output_type": output_type,
+            "experiences": experiences,
+            "unique": unique,
+        },
+        "statuses": statuses,
+        "elapsed_s": elapsed,
+        "throughput_rps": requests / elapsed if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base url of a running server, the app is driven in-process when omitted")
+    parser.add_argument("--endpoint", default="/raw_data", choices=["/", "/raw_data"])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--file-format", default="pdf", choices=["pdf", "docx"])
+    parser.add_argument("--output-type", default="file", choices=["file", "url"])
+    parser.add_argument("--experiences", type=int, default=10)
+    parser.add_argument("--cached", action="store_true", help="send identical profiles so repeats hit the cache")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+    results = asyncio.run(run(url=args.url, endpoint=args.endpoint, requests=args.requests,
+                              concurrency=args.concurrency, file_format=args.file_format,
+                              output_type=args.output_type, experiences=args.experiences, unique=not args.cached))
+    latency = results["latency_ms"]
+    print(f"{results['throughput_rps']:.1f} req/s, p50 {latency['p50']:.1f}ms, p95 {latency['p95']:.1f}ms, "
+          f"p99 {latency['p99']:.1f}ms, statuses {results['statuses']}", file=sys.stderr)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
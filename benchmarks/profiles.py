@@ -0,0 +1,58 @@
+"""
+path: benchmarks/profiles.py
+
+This file contains generators of synthetic profiles of configurable size.
+"""
+import random
+
+from app.schema import Profile, RawProfile
+
+WORDS = ("procurement economic policy analysis reform budget capacity regional public sector "
+         "evaluation programme delivery governance infrastructure finance health education").split()
+
+
+def sentence(rng, words=20):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def make_raw_profile(experiences=10, qualifications=3, skills=10, languages=3, countries=5, summaries=3,
+                     content_words=120, seed=0, name="Benchmark Consultant"):
+    """
+    Returns a RawProfile with the pipe/hash delimited fields filled with synthetic text
+    """
+    rng = random.Random(seed)
+    return RawProfile(
+        Name=name,
+        Title="Senior Consultant",
+        Qualifications="|".join(f"• MSc {rng.choice(WORDS).title()}, University {i}, {1990 + i}" for i in range(qualifications)),
+        TechnicalSkills=[f"{rng.choice(WORDS).title()} {i}" for i in range(skills)],
+        Languages=", ".join(f"Language{i} ({rng.choice(['excellent', 'good', 'basic'])})" for i in range(languages)),
+        Countries=[f"Country {i}" for i in range(countries)],
+        SummaryOfExperience="||".join(sentence(rng, content_words) for _ in range(summaries)),
+        ExperienceYears=",".join(f"{2000 + i % 20}-{2001 + i % 20}" for i in range(experiences)),
+        ExperienceHeader="|".join(f"{rng.choice(WORDS).title()} Lead, Organisation {i}, City {i}" for i in range(experiences)),
+        ExperienceContent="#".join(sentence(rng, content_words) for _ in range(experiences)),
+    )
+
+
+def make_profile(experiences=10, qualifications=3, skills=10, languages=3, countries=5, summaries=3,
+                 content_words=120, seed=0, name="Benchmark Consultant"):
+    """
+    Returns a structured Profile of the same shape as make_raw_profile
+    """
+    rng = random.Random(seed)
+    return Profile(
+        Name=name,
+        Title="Senior Consultant",
+        Qualifications=[{"Degree": "MSc", "Field": rng.choice(WORDS).title(), "Institution": f"University {i}",
+                         "Year": str(1990 + i)} for i in range(qualifications)],
+        TechnicalSkills=[f"{rng.choice(WORDS).title()} {i}" for i in range(skills)],
+        Languages=[{"Language": f"Language{i}", "Proficiency": rng.choice(["excellent", "good", "basic"])}
+                   for i in range(languages)],
+        Countries=[f"Country {i}" for i in range(countries)],
+        SummaryOfExperience=[sentence(rng, content_words) for _ in range(summaries)],
+        Experiences=[{"DateRange": f"{2000 + i % 20}-{2001 + i % 20}", "Position": f"{rng.choice(WORDS).title()} Lead",
+                      "Organisation": f"Organisation {i}", "Location": f"City {i}",
+                      "Summary": sentence(rng, content_words), "IsSelected": False}
+                     for i in range(experiences)],
+    )
@@ -4,13 +4,33 @@ path: app/main.py
 import logging
 import colorlog
 import sys
+import time
+import uuid
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from app.config import settings
+from app.bulk import shutdown_bulk_executor
+from app.converter import shutdown_converter_pool
+from app.executor import shutdown_render_executor
+from app.jobs import start_job_workers, stop_job_workers
+from app.metrics import request_id, request_stages, REQUEST_SECONDS
+from app.storage import local_storage_dir
 
 from app.routers import main
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the id of the request being served to every log record
+    """
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
 def configure_logging():
     """
     Configure logging for the application
@@ -21,7 +41,7 @@ def configure_logging():
     if not root_logger.handlers:
         # Create a formatter for formatting log messages
         formatter = colorlog.ColoredFormatter(
-            "%(log_color)s%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            "%(log_color)s%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s",
             log_colors={
                 'DEBUG':    'cyan',
                 'INFO':     'green',
@@ -35,6 +55,7 @@ def configure_logging():
         stream_handler = logging.StreamHandler(sys.stdout)
         stream_handler.setLevel(logging.INFO)
         stream_handler.setFormatter(formatter)
+        stream_handler.addFilter(RequestContextFilter())
 
         # Add the handlers to the root logger
         root_logger.addHandler(stream_handler)
@@ -48,6 +69,29 @@ configure_logging()
 app = FastAPI(title=settings.PROJECT_NAME, version="0.1.0", description="Generate CVs using ASI CV Generator.")
 
 app.include_router(main.router)
+if settings.STORAGE_BACKEND == "local":
+    # the local storage backend returns urls under /files
+    app.mount("/files", StaticFiles(directory=local_storage_dir(), check_dir=False), name="files")
+request_logger = logging.getLogger("app.requests")
+
+
+@app.middleware("http")
+async def log_request(request: Request, call_next):
+    """
+    Log every request with its duration and the time spent in each render stage
+    """
+    request_id.set(uuid.uuid4().hex[:12])
+    stages = {}
+    request_stages.set(stages)
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(elapsed, method=request.method, path=path)
+    timings = "".join(f" {name}={seconds:.3f}s" for name, seconds in stages.items())
+    request_logger.info("%s %s %s %.3fs%s", request.method, request.url.path, response.status_code, elapsed, timings)
+    return response
 origins = [
     "*",  # Allow all origins
 ]
@@ -62,6 +106,26 @@ app.add_middleware(
 # Configure your secret key
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key-here")
 
+
+@app.on_event("startup")
+def startup():
+    """
+    Start the worker processes that render async jobs
+    """
+    start_job_workers()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    """
+    Stop the job workers, render and bulk threads and LibreOffice workers when the application stops
+    """
+    stop_job_workers()
+    shutdown_render_executor()
+    shutdown_bulk_executor()
+    shutdown_converter_pool()
+
 if __name__ == "__main__":
+    # development server, production runs python -m app.serve
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
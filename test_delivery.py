@@ -0,0 +1,64 @@
+"""
+path: test_delivery.py
+
+Table driven tests of the byte range, ETag and If-Range parsing in app/delivery.py.
+"""
+import pytest
+
+from app.delivery import parse_range, etag_matches, if_range_matches, RangeNotSatisfiable
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-99", 1000, (0, 99)),
+    ("bytes=0-0", 1000, (0, 0)),
+    ("bytes=500-", 1000, (500, 999)),
+    # an end past the file is clamped to its last byte
+    ("bytes=900-5000", 1000, (900, 999)),
+    # suffix ranges are the last bytes, the whole file when longer than it
+    ("bytes=-100", 1000, (900, 999)),
+    ("bytes=-5000", 1000, (0, 999)),
+    (" bytes=10-19 ", 1000, (10, 19)),
+    # malformed, multiple and backwards ranges get the whole file
+    ("bytes=-", 1000, None),
+    ("bytes=a-b", 1000, None),
+    ("items=0-10", 1000, None),
+    ("bytes=0-10,20-30", 1000, None),
+    ("bytes=50-10", 1000, None),
+])
+def test_parse_range(header, size, expected):
+    assert parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=2000-3000", 1000),
+    ("bytes=-0", 1000),
+])
+def test_parse_range_not_satisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+@pytest.mark.parametrize("header, etag, expected", [
+    ('"abc"', '"abc"', True),
+    ('W/"abc"', '"abc"', True),
+    ('"xyz", "abc"', '"abc"', True),
+    ("*", '"abc"', True),
+    ('"xyz"', '"abc"', False),
+    ("", '"abc"', False),
+])
+def test_etag_matches(header, etag, expected):
+    assert etag_matches(header, etag) is expected
+
+
+@pytest.mark.parametrize("header, etag, expected", [
+    ('"abc"', '"abc"', True),
+    (' "abc" ', '"abc"', True),
+    # If-Range compares strongly, a weak tag, another tag or a date never matches
+    ('W/"abc"', '"abc"', False),
+    ('"xyz"', '"abc"', False),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", '"abc"', False),
+    ('W/"abc"', 'W/"abc"', False),
+])
+def test_if_range_matches(header, etag, expected):
+    assert if_range_matches(header, etag) is expected
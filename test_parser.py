@@ -0,0 +1,136 @@
+"""
+path: test_parser.py
+
+Table driven tests of the RawProfile and Profile parsers in app/parser.py.
+"""
+import pytest
+
+from app.parser import parse_raw_profile, parse_profile, parse_experiences, split_languages, parse_languages
+from app.schema import Profile, RawProfile, ParsedExperience, ParsedLanguage
+
+
+RAW = {
+    "Name": "Jane Doe",
+    "Title": "Economist",
+    "Qualifications": "• PhD Economics|• MSc Stats",
+    "TechnicalSkills": ["Modelling", "Stata"],
+    "Languages": "English (excellent), French (basic)",
+    "Countries": ["Kenya", "Uganda"],
+    "SummaryOfExperience": "Long summary one.||Summary two.",
+    "ExperienceYears": "2019-2020,2020-2021",
+    "ExperienceHeader": "Lead, World Bank|Advisor, DFID",
+    "ExperienceContent": "Did things#Did more things",
+}
+
+
+def raw_profile(**fields):
+    return RawProfile(**dict(RAW, **fields))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("English (excellent), French (basic)", [("English", "excellent"), ("French", "basic")]),
+    # commas inside the parentheses belong to the proficiency
+    ("English (excellent, native), French (basic)", [("English", "excellent, native"), ("French", "basic")]),
+    ("  English ( good ) ,French(basic)  ", [("English", "good"), ("French", "basic")]),
+    # stray and trailing separators are dropped
+    ("English (good),, French (basic)", [("English", "good"), ("French", "basic")]),
+    ("English (good),", [("English", "good")]),
+    ("", []),
+    # malformed fields are left to the entry by entry parse
+    ("English", None),
+    ("(good)", None),
+    ("English (good", None),
+    ("English (good) French (basic)", None),
+    ("English (good), French", None),
+])
+def test_split_languages(text, expected):
+    languages = split_languages(text)
+    if expected is None:
+        assert languages is None
+    else:
+        assert languages == [ParsedLanguage(*language) for language in expected]
+
+
+@pytest.mark.parametrize("text, expected, error_locs", [
+    ("English (good), French", [("English", "good")], [["Languages", 1]]),
+    ("English", [], [["Languages", 0]]),
+    ("(good), French (basic)", [("French", "basic")], [["Languages", 0]]),
+    # a missing closing parenthesis is tolerated
+    ("English (good", [("English", "good")], []),
+    ("   ", [], []),
+])
+def test_parse_languages_reports_malformed_entries(text, expected, error_locs):
+    errors = []
+    assert parse_languages(text, errors) == [ParsedLanguage(*language) for language in expected]
+    assert [error["loc"] for error in errors] == error_locs
+
+
+@pytest.mark.parametrize("years, headers, contents, expected, error", [
+    ("2019-2020,2020-2021", "Lead, World Bank|Advisor, DFID", "Did things#Did more things",
+     [("2019-2020", "Lead, World Bank", "Did things"), ("2020-2021", "Advisor, DFID", "Did more things")], None),
+    (" 2019 ", " Lead ", " Did things ", [("2019", "Lead", "Did things")], None),
+    ("", "", "", [], None),
+    # a missing year or header is left empty
+    ("2019", "Lead|Advisor", "Did things#Did more", [("2019", "Lead", "Did things"), ("", "Advisor", "Did more")], None),
+    ("2019,2020", "Lead", "Did things#Did more", [("2019", "Lead", "Did things"), ("2020", "", "Did more")], None),
+    # content beyond the years and headers is ignored
+    ("2019", "Lead", "Did things#Did more", [("2019", "Lead", "Did things")], None),
+    ("2019,2020", "Lead|Advisor", "Did things", [], "expected 2 entries separated by '#', got 1"),
+])
+def test_parse_experiences(years, headers, contents, expected, error):
+    errors = []
+    profile = raw_profile(ExperienceYears=years, ExperienceHeader=headers, ExperienceContent=contents)
+    assert parse_experiences(profile, errors) == [ParsedExperience(*experience) for experience in expected]
+    if error is None:
+        assert errors == []
+    else:
+        assert errors == [{"loc": ["ExperienceContent"], "msg": error, "type": "value_error"}]
+
+
+@pytest.mark.parametrize("fields, attribute, expected", [
+    ({}, "Qualifications", ["PhD Economics", "MSc Stats"]),
+    ({"Qualifications": "|• PhD Economics||MSc Stats |"}, "Qualifications", ["PhD Economics", "MSc Stats"]),
+    ({"Qualifications": ""}, "Qualifications", []),
+    ({}, "SummaryOfExperience", ["Long summary one.", "Summary two."]),
+    ({"SummaryOfExperience": " one || || two ||"}, "SummaryOfExperience", ["one", "two"]),
+    ({}, "Languages", [ParsedLanguage("English", "excellent"), ParsedLanguage("French", "basic")]),
+    ({}, "TechnicalSkills", ["Modelling", "Stata"]),
+    ({}, "Countries", ["Kenya", "Uganda"]),
+])
+def test_parse_raw_profile(fields, attribute, expected):
+    parsed, errors = parse_raw_profile(raw_profile(**fields))
+    assert errors == []
+    assert getattr(parsed, attribute) == expected
+
+
+@pytest.mark.parametrize("fields, error_locs", [
+    ({"Languages": "English"}, [["Languages", 0]]),
+    ({"ExperienceContent": "Did things"}, [["ExperienceContent"]]),
+    ({"Languages": "English (good), French", "ExperienceContent": ""}, [["Languages", 1], ["ExperienceContent"]]),
+])
+def test_parse_raw_profile_errors(fields, error_locs):
+    _, errors = parse_raw_profile(raw_profile(**fields))
+    assert [error["loc"] for error in errors] == error_locs
+
+
+def test_parse_profile_builds_header_and_content():
+    profile = Profile(
+        Name="Jane Doe",
+        Title="Economist",
+        Qualifications=[{"Degree": "PhD", "Field": "Economics", "Institution": "LSE", "Year": "2010"}],
+        TechnicalSkills=["Stata"],
+        Languages=[{"Language": "English", "Proficiency": "excellent"}],
+        Countries=["Kenya"],
+        SummaryOfExperience=["Summary."],
+        Experiences=[
+            {"DateRange": "2019-2020", "Position": "Lead", "Organisation": "World Bank", "Location": "Nairobi", "Summary": "Did things", "IsSelected": True},
+            {"DateRange": "2020-2021", "Position": "Advisor", "Organisation": "DFID", "Location": "Kampala", "Summary": "Did more"},
+        ],
+    )
+    parsed = parse_profile(profile)
+    assert parsed.Qualifications == ["PhD in Economics from LSE in 2010"]
+    assert parsed.Languages == [ParsedLanguage("English", "excellent")]
+    assert parsed.Experiences == [
+        ParsedExperience("2019-2020", "Lead, World Bank, Nairobi", "Did things", True),
+        ParsedExperience("2020-2021", "Advisor, DFID, Kampala", "Did more", False),
+    ]
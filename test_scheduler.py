@@ -0,0 +1,149 @@
+"""
+path: test_scheduler.py
+
+Tests of the stride order, client cap, deadlines and cancellation of the PriorityScheduler in app/scheduler.py.
+"""
+import time
+import threading
+
+import pytest
+
+from app.scheduler import PriorityScheduler, Waiter, INTERACTIVE, BULK
+from app.utils import ConversionCancelled
+
+
+def queue(scheduler, priority, *clients):
+    """
+    Queues a waiter of priority for every client without waiting on it
+    """
+    waiters = [Waiter(client) for client in clients]
+    scheduler._queues[priority].extend(waiters)
+    return waiters
+
+
+def grant_order(scheduler, waiters, count):
+    """
+    Returns the priority of the next count waiters to get the single slot, releasing it after each grant
+    """
+    priorities = {id(waiter): priority for priority, queued in waiters.items() for waiter in queued}
+    order, seen = [], set()
+    with scheduler._condition:
+        scheduler._dispatch()
+    while len(order) < count:
+        granted = [waiter for queued in waiters.values() for waiter in queued if waiter.granted and id(waiter) not in seen]
+        assert len(granted) == 1
+        seen.add(id(granted[0]))
+        order.append(priorities[id(granted[0])])
+        scheduler.release()
+    return order
+
+
+@pytest.mark.parametrize("weights, expected", [
+    ({INTERACTIVE: 1.0, BULK: 1.0}, "IBIBIBIBIB"),
+    ({INTERACTIVE: 4.0, BULK: 1.0}, "IBIIIIBIII"),
+    ({INTERACTIVE: 1.0, BULK: 4.0}, "IBBBBIBBBB"),
+    ({INTERACTIVE: 2.0, BULK: 1.0}, "IBIIBIIBII"),
+])
+def test_stride_order_follows_the_weights(weights, expected):
+    scheduler = PriorityScheduler(1, weights)
+    waiters = {priority: queue(scheduler, priority, *[None] * 10) for priority in weights}
+    order = grant_order(scheduler, waiters, len(expected))
+    assert "".join(priority[0].upper() for priority in order) == expected
+
+
+def test_a_class_alone_gets_every_slot():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 4.0, BULK: 1.0})
+    waiters = {INTERACTIVE: [], BULK: queue(scheduler, BULK, *[None] * 5)}
+    assert grant_order(scheduler, waiters, 5) == [BULK] * 5
+
+
+def test_within_a_class_waiters_are_served_in_arrival_order():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 1.0, BULK: 1.0})
+    first, second, third = queue(scheduler, BULK, "a", "b", "c")
+    with scheduler._condition:
+        scheduler._dispatch()
+    assert (first.granted, second.granted, third.granted) == (True, False, False)
+    scheduler.release("a")
+    assert (second.granted, third.granted) == (True, False)
+
+
+@pytest.mark.parametrize("client_limit, clients, granted", [
+    # the second waiter of a is skipped for b while a holds its one slot
+    (1, ["a", "a", "b"], [True, False, True]),
+    (2, ["a", "a", "a", "b"], [True, True, False, True]),
+    # no limit, or no client, serves the waiters in order
+    (0, ["a", "a", "a", "b"], [True, True, True, False]),
+    (1, [None, None, None, "b"], [True, True, True, False]),
+])
+def test_client_limit_caps_the_slots_of_a_client(client_limit, clients, granted):
+    scheduler = PriorityScheduler(3, {INTERACTIVE: 1.0, BULK: 1.0}, client_limit=client_limit)
+    waiters = queue(scheduler, INTERACTIVE, *clients)
+    with scheduler._condition:
+        scheduler._dispatch()
+    assert [waiter.granted for waiter in waiters] == granted
+
+
+def test_a_capped_client_gets_its_next_slot_on_release():
+    scheduler = PriorityScheduler(2, {INTERACTIVE: 1.0, BULK: 1.0}, client_limit=1)
+    first, second = queue(scheduler, INTERACTIVE, "a", "a")
+    with scheduler._condition:
+        scheduler._dispatch()
+    assert (first.granted, second.granted) == (True, False)
+    assert scheduler.running == 1
+    scheduler.release("a")
+    assert second.granted
+    assert scheduler._clients == {"a": 1}
+    scheduler.release("a")
+    assert scheduler.running == 0 and scheduler._clients == {}
+
+
+def test_acquire_gives_up_at_the_deadline():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 1.0, BULK: 1.0})
+    assert scheduler.acquire(INTERACTIVE)
+    start = time.monotonic()
+    assert not scheduler.acquire(BULK, deadline=start + 0.1)
+    assert 0.1 <= time.monotonic() - start < 1
+    assert scheduler.waiting(BULK) == 0
+    scheduler.release()
+    assert scheduler.running == 0
+
+
+def test_acquire_gives_up_when_cancelled():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 1.0, BULK: 1.0})
+    assert scheduler.acquire(INTERACTIVE)
+    cancel = threading.Event()
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(scheduler.acquire(BULK, cancel=cancel)))
+    waiter.start()
+    time.sleep(0.05)
+    assert scheduler.waiting(BULK) == 1
+    cancel.set()
+    waiter.join(2)
+    assert result == [False]
+    assert scheduler.waiting(BULK) == 0 and scheduler.running == 1
+
+
+def test_acquire_waits_for_a_release():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 1.0, BULK: 1.0})
+    assert scheduler.acquire(INTERACTIVE)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(scheduler.acquire(BULK, deadline=time.monotonic() + 5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert result == []
+    scheduler.release()
+    waiter.join(2)
+    assert result == [True]
+    assert scheduler.running == 1
+
+
+def test_slot_raises_when_cancelled_and_releases_on_exit():
+    scheduler = PriorityScheduler(1, {INTERACTIVE: 1.0, BULK: 1.0})
+    with scheduler.slot():
+        assert scheduler.running == 1
+        cancel = threading.Event()
+        cancel.set()
+        with pytest.raises(ConversionCancelled):
+            with scheduler.slot(cancel=cancel):
+                pass
+    assert scheduler.running == 0